@@ -0,0 +1,136 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import os
+import mmap
+import json
+import hashlib
+import tempfile
+import traceback
+
+
+def default_cache_dir(name='audio'):
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+    return os.path.join(base, 'spotifyfs', name)
+
+
+class AudioCache:
+    """
+    Content-addressed on-disk cache of encoded MP3 streams.
+
+    Entries are keyed by track id + LAME parameters, so changing the bitrate
+    produces a different file. The cache is kept under `max_size` bytes by
+    evicting the least recently used entries (Using the file mtime, which is
+    bumped on every hit).
+    """
+
+    def __init__(self, path=None, max_size=2*1024*1024*1024):
+        self.path = path or default_cache_dir()
+        self.max_size = max_size
+        os.makedirs(self.path, exist_ok=True)
+
+        # Leftovers from writers that never finished
+        for name in os.listdir(self.path):
+            if name.endswith('.part'):
+                try:
+                    os.unlink(os.path.join(self.path, name))
+                except OSError:
+                    pass
+
+    @staticmethod
+    def key(track_id, lame_args):
+        params = json.dumps(lame_args, sort_keys=True, default=str)
+        return hashlib.sha1(f'{track_id}:{params}'.encode('utf-8')).hexdigest()
+
+    def _filename(self, key):
+        return os.path.join(self.path, key + '.mp3')
+
+    def open(self, track_id, lame_args):
+        """
+        Returns a read-only memory map of a complete encode, or None if it isn't cached.
+        """
+        filename = self._filename(self.key(track_id, lame_args))
+        try:
+            with open(filename, 'rb') as f:
+                os.utime(filename)
+                if os.fstat(f.fileno()).st_size == 0:
+                    return b''
+                return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except FileNotFoundError:
+            return None
+
+    def contains(self, track_id, lame_args):
+        return os.path.exists(self._filename(self.key(track_id, lame_args)))
+
+    def size(self, track_id, lame_args):
+        try:
+            return os.stat(self._filename(self.key(track_id, lame_args))).st_size
+        except FileNotFoundError:
+            return None
+
+    def writer(self, track_id, lame_args):
+        return AudioCache.Writer(self, self.key(track_id, lame_args))
+
+    def evict(self):
+        """
+        Removes least recently used entries until the cache fits in `max_size`
+        """
+        entries = []
+        total = 0
+        for name in os.listdir(self.path):
+            if not name.endswith('.mp3'):
+                continue
+            try:
+                st = os.stat(os.path.join(self.path, name))
+            except FileNotFoundError:
+                continue
+            entries.append((st.st_mtime, st.st_size, name))
+            total += st.st_size
+
+        entries.sort()
+        for mtime, size, name in entries:
+            if total <= self.max_size:
+                break
+            try:
+                os.unlink(os.path.join(self.path, name))
+                total -= size
+            except FileNotFoundError:
+                pass
+
+    class Writer:
+        """
+        Receives the MP3 stream as it is encoded.
+
+        Data goes into a temporary file, which only becomes visible to readers
+        after `commit()`, so partial streams are never served.
+        """
+        def __init__(self, cache, key):
+            self.cache = cache
+            self.key = key
+            fd, self.tmp_name = tempfile.mkstemp(dir=cache.path, prefix=key, suffix='.part')
+            self.file = os.fdopen(fd, 'wb')
+
+        def write(self, data):
+            if self.file is not None:
+                self.file.write(data)
+
+        def commit(self):
+            if self.file is None:
+                return
+            try:
+                self.file.close()
+                self.file = None
+                os.replace(self.tmp_name, self.cache._filename(self.key))
+                self.cache.evict()
+            except:
+                traceback.print_exc()
+                self.abort()
+
+        def abort(self):
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+            try:
+                os.unlink(self.tmp_name)
+            except FileNotFoundError:
+                pass
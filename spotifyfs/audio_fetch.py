@@ -3,134 +3,514 @@
 
 from librespot import Session, SpotifyId
 import os
+import mmap
 import asyncio
 import traceback
 import time
 import sys
 from io import BytesIO
 import subprocess
-from lame import Lame
+import concurrent.futures
+from lame import Lame, cbr_frame_start, cbr_frame_offset, cbr_padding_period
+from stream_buffer import StreamBuffer, MemoryBudget
+from audio_cache import AudioCache
+from playback_scheduler import PlaybackScheduler, PRIORITY_INTERACTIVE, PRIORITY_PREFETCH
+import metrics
 import numpy as np
 import math
 
 class LameSink:
+    """
+    Receives PCM from a worker's player, and forwards it to the stream segment attached to it
+    """
     def __init__(self):
         self.target = None
 
+    def attach(self, target):
+        self.target = target
+
+    def detach(self, target):
+        # Only if it is still attached -- The worker might already be playing something else
+        if self.target is target:
+            self.target = None
+
     def write(self, buf):
         try:
+            target = self.target
+            if target is None:
+                return  # Leftovers of a stream that has already been detached
+
             buf = np.frombuffer(buf, np.int16)
 
-            asyncio.run_coroutine_threadsafe(
-                    self.target._load_chunk(buf),
-                    loop = self.target.audio_fetcher.loop).result()
+            # Encoding happens on the worker's encoder thread, the event loop only receives MP3 data
+            target.worker.encoder.submit(target._encode_chunk, buf)
         except:
             traceback.print_exc()
             raise
 
-class SpotifyAudioFetcher():
-    def __init__(self, loop):
-        self.loop = loop
-        self.semaphore = asyncio.Semaphore()
+class PlaybackWorker:
+    """
+    A Spotify session with its own player and sink. Each worker plays one track at a time.
+    """
+    def __init__(self, name):
+        self.name = name
         self.sink = LameSink()
         self.session = Session.connect('1252589511', '32413399', self.sink).result()
         self.player = self.session.player()
 
+        # A single thread, so that the chunks of a stream are encoded in order by the same LAME context
+        self.encoder = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix=name + '-lame')
 
-    def play(self, trackId, lame_args={}):
-        class reader:
-            def __init__(self, audio_fetcher):
-                self.audio_fetcher = audio_fetcher
+
+class SpotifyAudioFetcher():
+    def __init__(self, loop, audio_cache=None, num_workers=2, memory_limit=256*1024*1024, seekable=False, seek_threshold_ms=30000):
+        self.loop = loop
+        self.audio_cache = audio_cache
+
+        # Reads more than `seek_threshold_ms` ahead of what has been encoded start a second playback from there
+        self.seekable = seekable
+        self.seek_threshold_ms = seek_threshold_ms
+
+        # Streams above this limit (All of them together) get spilled to memory-mapped temporary files,
+        # written by their own thread so that the event loop doesn't wait for the disk
+        self.spill_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='spill')
+        self.memory_budget = MemoryBudget(memory_limit, loop, self.spill_executor)
+
+        # Pool of sessions: Each `play()` gets dispatched to a free worker, by priority
+        self.workers = [PlaybackWorker('worker-%d' % i) for i in range(num_workers)]
+        self.scheduler = PlaybackScheduler(self.workers)
+
+        # Streams currently open, so that a track being prefetched can be picked up by a reader
+        self.streams = {}
+        self.prefetches = set()
+
+        metrics.registry.gauge('spotifyfs_playback_streams_active', 'Track streams being read or prefetched',
+                               lambda: len(self.streams))
+        metrics.registry.gauge('spotifyfs_playback_queue_length', 'Streams waiting for a playback worker',
+                               lambda: len(self.scheduler.waiting))
+
+    def release_worker(self, worker):
+        self.scheduler.release(worker)
+
+
+    def prefetch(self, trackId, lame_args={}):
+        """
+        Plays a track in background, into the AudioCache
+        """
+        if self.audio_cache is None:
+            return
+        stream_key = AudioCache.key(trackId, lame_args)
+        if stream_key in self.streams or self.audio_cache.contains(trackId, lame_args):
+            return
+
+        async def run():
+            print('Prefetching %s' % trackId)
+            playback = self.play(trackId, lame_args, priority=PRIORITY_PREFETCH)
+            try:
+                await playback.wait_finished()
+            except:
+                print('Prefetch of %s failed' % trackId)
+            finally:
+                await playback.close()
+
+        task = asyncio.ensure_future(run())
+        self.prefetches.add(task)
+        task.add_done_callback(self.prefetches.discard)
+
+
+    def play(self, trackId, lame_args={}, priority=PRIORITY_INTERACTIVE, size=None):
+        """
+        Returns a reader of the MP3 stream of a track.
+
+        `size` is the expected size of the stream, if known. Seeking ahead of the encoded audio needs it.
+        """
+        stream_key = AudioCache.key(trackId, lame_args)
+        stream = self.streams.get(stream_key, None)
+        if stream is not None and stream.error is None:
+            stream.refs += 1
+            stream.boost(priority)
+            return stream
+
+        if self.audio_cache is not None:
+            cached = self.audio_cache.open(trackId, lame_args)
+            if cached is not None:
+                print('Playing %s from cache' % trackId)
+                metrics.playback_streams.inc(source='cache')
+                return cached_reader(cached)
+
+        audio_fetcher = self
+
+        class segment:
+            """
+            One playback of the track, starting at `position_ms`, encoded into its own buffer.
+
+            Its data goes at `start_offset` of the MP3 stream. The first `skip` bytes of its encode
+            are dropped, and at most `limit` bytes are kept.
+            """
+            def __init__(self, owner, start_offset=0, position_ms=0, cache=False, skip=0, limit=None):
+                self.owner = owner
+                self.start_offset = start_offset
+                self.position_ms = position_ms
+                self.cache = cache
+                self.skip = skip
+                self.limit = limit
                 self.lame = None
-                self.buf = b''
+                self.buf = StreamBuffer(audio_fetcher.memory_budget)
                 self.load_future = None
+                self.task = None
+                self.ticket = None
+                self.worker = None
+                self.worker_to_release = None
+                self.cache_writer = None
+                self.started_at = None
                 self.finished = False
-                self.error = False
+                self.error = None
+
+            @property
+            def end_offset(self):
+                return self.start_offset + len(self.buf)
+
+            def launch(self):
+                self.task = asyncio.ensure_future(self.start())
+
+            async def start(self):
+                print('Waiting to play %s at %dms' % (trackId, self.position_ms))
+                try:
+                    self.ticket = audio_fetcher.scheduler.enqueue(self.owner.priority)
+                    self.worker = await audio_fetcher.scheduler.wait(self.ticket)
+                except asyncio.CancelledError:
+                    # Stopped while waiting -- The scheduler has already dropped the ticket
+                    await self._fail(asyncio.CancelledError())
+                    return
+
+                if self.error is not None:
+                    # Stopped right after getting a worker
+                    await self._fail(self.error)
+                    return
+                print('Playing %s at %dms on %s' % (trackId, self.position_ms, self.worker.name))
+                metrics.playback_streams.inc(source='seek' if self.position_ms else 'spotify')
+                self.started_at = time.monotonic()
+
+                try:
+                    self.lame = Lame(**lame_args)
+                    self.lame.init_params()
+
+                    if self.cache and audio_fetcher.audio_cache is not None:
+                        self.cache_writer = audio_fetcher.audio_cache.writer(trackId, lame_args)
+
+                    self.worker_to_release = self.worker
+                    self.worker.sink.attach(self)
+
+                    if self.position_ms:
+                        load_future = self.worker.player.load(SpotifyId(trackId), True, self.position_ms)
+                    else:
+                        load_future = self.worker.player.load(SpotifyId(trackId))
+                except Exception as e:
+                    traceback.print_exc()
+                    await self._fail(e)
+                    return
+
+                self.load_future = asyncio.futures.wrap_future(load_future, loop = audio_fetcher.loop)
+                def done_cb(fut):
+                    error = asyncio.CancelledError() if fut.cancelled() else fut.exception()
+                    asyncio.ensure_future(self._load_complete(error))
+                self.load_future.add_done_callback(done_cb)
+
+            def _release_worker(self):
+                """
+                Gives the worker back to the pool. Safe to call more than once.
+                """
+                worker, self.worker_to_release = self.worker_to_release, None
+                if worker is not None:
+                    worker.sink.detach(self)
+                    audio_fetcher.release_worker(worker)
+
+            async def _fail(self, error):
+                """
+                Playback could not start
+                """
+                if self.worker is not None:
+                    self.worker_to_release = self.worker
+                    self._release_worker()
+                if self.cache_writer is not None:
+                    self.cache_writer.abort()
+                    self.cache_writer = None
+                async with self.owner.cond:
+                    self.finished = True
+                    if self.error is None:
+                        self.error = error
+                    self.owner.cond.notify_all()
+
+            def _encode_chunk(self, buf):
+                # Runs on the worker's encoder thread
+                try:
+                    with metrics.encode_chunk_seconds.time():
+                        encoded = self.lame.encode_buffer(buf)
+                    asyncio.run_coroutine_threadsafe(
+                            self._load_chunk(encoded),
+                            loop = audio_fetcher.loop).result()
+                except:
+                    traceback.print_exc()
+
+            def _trim(self, encoded):
+                if self.skip:
+                    skipped = min(self.skip, len(encoded))
+                    encoded = encoded[skipped:]
+                    self.skip -= skipped
+                if self.limit is not None and len(self.buf) + len(encoded) > self.limit:
+                    encoded = encoded[:max(0, self.limit - len(self.buf))]
+                return encoded
+
+            async def _load_chunk(self, encoded):
+                #Append encoded data
+                metrics.playback_bytes.inc(len(encoded))
+                async with self.owner.cond:
+                    encoded = self._trim(encoded)
+                    self.buf.append(encoded)
+                    if self.cache_writer is not None:
+                        self.cache_writer.write(encoded)
+                    self.owner.cond.notify_all()
+
+            async def _load_complete(self, error):
+                print('Audio stream ended:', trackId)
+
+                self.worker.sink.detach(self)
+
+                try:
+                    #Finish encoding -- Queued after all pending chunks
+                    encoded = await audio_fetcher.loop.run_in_executor(self.worker.encoder, self.lame.encode_flush_nogap)
+                except Exception as e:
+                    encoded = b''
+                    error = error or e
+                finally:
+                    # Release audio_fetcher to play next track
+                    self._release_worker()
+                metrics.playback_bytes.inc(len(encoded))
+                if error is None:
+                    metrics.playback_stream_seconds.observe(time.monotonic() - self.started_at)
+
+                async with self.owner.cond:
+                    encoded = self._trim(encoded)
+                    self.buf.append(encoded)
+                    self.finished = True
+                    if self.error is None and error:
+                        self.error = error
+
+                    if self.cache_writer is not None:
+                        self.cache_writer.write(encoded)
+                        if self.error is None:
+                            self.cache_writer.commit()
+                        else:
+                            self.cache_writer.abort()
+                        self.cache_writer = None
+                    self.owner.cond.notify_all()
+
+            def stop(self):
+                """
+                Stops playback. Must be called with the owner's condition held.
+                """
+                if not self.finished:
+                    self.error = asyncio.CancelledError()
+                    if self.worker_to_release is not None:
+                        # Still playing -- _load_complete() will release the worker.
+                        # (Once released, the worker might be playing something else already)
+                        self.worker.player.stop()
+                    elif self.task is not None and self.worker is None:
+                        # Still waiting for a worker
+                        self.task.cancel()
+                    self.finished = self.load_future is None
+                    self.owner.cond.notify_all()
+                self.buf.close()
+
+        class reader:
+            def __init__(self, audio_fetcher):
+                self.audio_fetcher = audio_fetcher
+                self.refs = 1
+                self.priority = priority
                 self.cond = asyncio.Condition()
 
-            async def ensure_playing(self):
-                async with self.cond:
-                    if not self.load_future:
+                # The complete stream, which goes to the AudioCache
+                self.primary = segment(self, cache=True)
+                # Playback started ahead of the primary segment, to serve a seek
+                self.seek_segment = None
+
+            @property
+            def buf(self):
+                return self.primary.buf
 
-                        print('Waiting to play %s' % trackId)
-                        self.audio_fetcher.semaphore.acquire()
-                        print('Playing %s' % trackId)
+            @property
+            def finished(self):
+                return self.primary.finished
 
-                        self.lame = Lame(**lame_args)
-                        self.lame.init_params()
+            @property
+            def error(self):
+                return self.primary.error
 
-                        self.audio_fetcher.sink.target = self
+            def boost(self, priority):
+                """
+                Raises the priority of this stream, also for segments waiting for a worker
+                """
+                self.priority = min(self.priority, priority)
+                for seg in (self.primary, self.seek_segment):
+                    if seg is not None and seg.ticket is not None:
+                        audio_fetcher.scheduler.boost(seg.ticket, self.priority)
 
-                        load_future = self.audio_fetcher.player.load(SpotifyId(trackId))
-                        self.load_future = asyncio.futures.wrap_future(load_future, loop = self.audio_fetcher.loop)
-                        def done_cb(fut):
-                            x = asyncio.run_coroutine_threadsafe(
-                                    self._load_complete(fut.exception()),
-                                    loop = self.audio_fetcher.loop)
-                        self.load_future.add_done_callback(done_cb)
+            async def ensure_playing(self):
+                # Doesn't wait for a worker: Readers wait for data on `cond`, and close() can stop it anytime
+                if self.primary.task is None:
+                    self.primary.launch()
+
+            def _seek_distance(self):
+                """
+                How far ahead of the primary segment reads will start a new segment, in bytes
+                """
+                bitrate = lame_args.get('bitrate', None)
+                if not audio_fetcher.seekable or bitrate is None or size is None:
+                    return None
+                return audio_fetcher.seek_threshold_ms * bitrate // 8
+
+            async def _seek(self, offset):
+                """
+                Starts a segment at `offset`, unless the current one will soon reach it.
+
+                CBR maps byte offsets to frames, and frames to playback positions: The segment starts
+                on a frame at or before `offset`, where LAME's padding pattern is the same as at the start
+                of a stream, so that all its frames have the same offsets as in the primary segment.
+
+                The segment is a separate LAME stream: Its Info frame and its first audio frame (Which holds
+                the encoder delay) are dropped, and playback starts one frame earlier to make up for them.
+                Its frames hold the same audio as the primary segment's, but they are encoded independently
+                (The first one might even refer to the dropped frame's bit reservoir), so they are only
+                served to reads far ahead of the primary segment.
+                """
+                distance = self._seek_distance()
+                bitrate = lame_args['bitrate']
+                async with self.cond:
+                    if self.primary.finished or offset <= self.primary.end_offset + distance or offset >= size:
+                        return
+                    seg = self.seek_segment
+                    if seg is not None and seg.start_offset <= offset <= seg.end_offset + distance:
+                        return
+                    if seg is not None:
+                        seg.stop()
+
+                    frame, start_offset = cbr_frame_start(offset, bitrate)
+                    period = cbr_padding_period(bitrate)
+                    frame = 2 + (frame - 2) // period * period
+                    if frame < 2:
+                        return
+                    start_offset = cbr_frame_offset(frame, bitrate)
+                    seg = segment(
+                            self,
+                            start_offset=start_offset,
+                            position_ms=(frame - 2) * 1152 * 1000 // 44100,
+                            skip=cbr_frame_offset(2, bitrate),
+                            limit=size - start_offset)
+                    self.seek_segment = seg
+                    seg.launch()
+                    self.cond.notify_all()
+
+            def _available(self, offset, min_buf_size):
+                """
+                Returns the segment that can serve a read at `offset`, or None if we need to wait
+
+                Only the primary segment can tell where the stream ends: Reads past the end of a finished
+                seek segment wait for it. So do reads close to the primary segment, which will soon have them.
+                """
+                if self.primary.finished or self.primary.end_offset >= min_buf_size:
+                    return self.primary
+                seg = self.seek_segment
+                if seg is None or offset <= self.primary.end_offset + self._seek_distance():
+                    return None
+                if seg.start_offset <= offset < seg.end_offset and (seg.finished or seg.end_offset >= min_buf_size):
+                    return seg
+                return None
 
             async def read(self, offset, length, full=False):
+                self.boost(PRIORITY_INTERACTIVE)
                 await self.ensure_playing()
 
+                if self._seek_distance() is not None:
+                    await self._seek(offset)
+
                 async with self.cond:
                     min_buf_size = offset + length if full else offset + 1
 
                     # Wait until: Enough data is available -OR- the strean is complete -OR- there was an error
-                    await self.cond.wait_for(lambda: self.finished or len(self.buf) >= min_buf_size)
+                    await self.cond.wait_for(lambda: self._available(offset, min_buf_size) is not None)
+                    seg = self._available(offset, min_buf_size)
 
                     # raise exception if there was an error before the desired chunk was fetched
-                    if len(self.buf) < min_buf_size:
-                        self.load_future.result()
+                    if seg.end_offset < min_buf_size and seg.error is not None and not isinstance(seg.error, asyncio.CancelledError):
+                        raise seg.error
+
+                    # Once the primary segment has caught up, the seek segment is useless
+                    if self.seek_segment is not None and self.seek_segment.finished and self.primary.end_offset >= self.seek_segment.end_offset:
+                        self.seek_segment.stop()
+                        self.seek_segment = None
 
                     # return the desired chunk
-                    return self.buf[offset:offset+length]
+                    return seg.buf.read(offset - seg.start_offset, length)
 
+            async def close(self):
+                self.refs -= 1
+                if self.refs > 0:
+                    return
+                if audio_fetcher.streams.get(stream_key, None) is self:
+                    del audio_fetcher.streams[stream_key]
 
-            async def _load_chunk(self, buf):
-                #Append data to encoding
-                encoded = self.lame.encode_buffer(buf)
+                print('File reader closed for %s' % trackId)
                 async with self.cond:
-                    self.buf += encoded
-                    self.cond.notify_all()
+                    self.primary.stop()
+                    if self.seek_segment is not None:
+                        self.seek_segment.stop()
+                        self.seek_segment = None
+
+            async def wait_finished(self):
+                """
+                Waits until the whole track has been encoded, without copying it
+                """
+                await self.ensure_playing()
+                async with self.cond:
+                    await self.cond.wait_for(lambda: self.primary.finished)
+                    if self.primary.error:
+                        raise Exception("Failed to fetch music")
 
+            async def wait(self):
+                await self.wait_finished()
+                async with self.cond:
+                    return self.primary.buf.getvalue()
 
-            async def _load_complete(self, error):
-                print('Audio stream ended:', trackId)
 
-                # Release audio_fetcher to play next track
-                self.audio_fetcher.sink.target = None
-                self.audio_fetcher.semaphore.release()
 
-                #Finish encoding
-                encoded = self.lame.encode_flush_nogap()
+        stream = reader(self)
+        self.streams[stream_key] = stream
+        return stream
 
-                async with self.cond:
-                    self.buf += encoded
-                    self.finished = True
-                    if self.error is None and error:
-                        self.error = error
-                    self.cond.notify_all()
-                    print('Audio stream ended2')
 
-            async def close(self):
-                print('File reader closed for %s' % trackId)
-                async with self.cond:
-                    if not self.finished:
-                        self.error = asyncio.CancelledError()
-                        if self.load_future:
-                            self.audio_fetcher.player.stop()
+class cached_reader:
+    """
+    Same interface as the readers returned by `SpotifyAudioFetcher.play()`, backed by a complete encode from the AudioCache
+    """
+    def __init__(self, buf):
+        self.buf = buf
+        self.finished = True
+        self.error = None
 
-            async def wait(self):
-                await self.ensure_playing()
-                async with self.cond:
-                    await self.cond.wait_for(lambda: self.finished)
-                    if self.error:
-                        raise Exception("Failed to fetch music")
-                    return self.buf
+    async def read(self, offset, length, full=False):
+        return self.buf[offset:offset+length]
 
+    async def close(self):
+        # The mmap holds its own file descriptor, don't wait for the GC to release it
+        buf, self.buf = self.buf, b''
+        if isinstance(buf, mmap.mmap):
+            buf.close()
 
+    async def wait_finished(self):
+        pass
 
-        return reader(self)
+    async def wait(self):
+        return self.buf
 
 
 if __name__ == '__main__':
@@ -0,0 +1,76 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import asyncio
+import metrics
+
+
+class BatchFetcher:
+    """
+    Fetches single objects using Spotify's multi-id endpoints (E.g., `artists?ids=a,b,c`).
+
+    Lookups are collected for `delay` seconds (or until `max_ids` are pending), and resolved
+    by a single request. Results are kept in SpotifyFS.cache.
+    """
+
+    def __init__(self, spotifyfs, endpoint, max_ids, delay=0.02, params=None):
+        self.spotifyfs = spotifyfs
+        self.endpoint = endpoint
+        self.max_ids = max_ids
+        self.delay = delay
+        self.params = params or {}
+        self.pending = {}
+        self.flush_handle = None
+
+    def cache_id(self, id):
+        return (self.endpoint, id)
+
+    def prime(self, obj, id=None):
+        """
+        Stores an object that came as part of another response.
+
+        `id` is the id it was requested with, if any: With a market, Spotify might relink a track
+        and return it with a different id, and it must be found again under the requested one.
+        """
+        self.spotifyfs.cache[self.cache_id(obj['id'])] = obj
+        if id is not None and id != obj['id']:
+            self.spotifyfs.cache[self.cache_id(id)] = obj
+
+    async def get(self, id):
+        cached = self.spotifyfs.cache.get(self.cache_id(id), None)
+        metrics.content_cache.inc(result='miss' if cached is None else 'hit')
+        if cached is not None:
+            return cached
+
+        future = self.pending.get(id, None)
+        if future is None:
+            loop = asyncio.get_event_loop()
+            future = loop.create_future()
+            self.pending[id] = future
+            if len(self.pending) >= self.max_ids:
+                self.flush()
+            elif self.flush_handle is None:
+                self.flush_handle = loop.call_later(self.delay, self.flush)
+        return await asyncio.shield(future)
+
+    def flush(self):
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        batch, self.pending = self.pending, {}
+        if batch:
+            asyncio.ensure_future(self._fetch(batch))
+
+    async def _fetch(self, batch):
+        try:
+            response = await self.spotifyfs.request(self.endpoint, params={**self.params, 'ids': ','.join(batch)})
+            for (id, future), obj in zip(batch.items(), response[self.endpoint]):
+                if obj is None:
+                    future.set_exception(KeyError(f'{self.endpoint}/{id} not found'))
+                else:
+                    self.prime(obj, id)
+                    future.set_result(obj)
+        except Exception as e:
+            for future in batch.values():
+                if not future.done():
+                    future.set_exception(e)
@@ -0,0 +1,87 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+Measures the cost of listing huge directories: Listing latency and process RSS
+for artists with 10k albums each. Doesn't talk to Spotify.
+
+    python bench_listing.py [num_artists] [albums_per_artist]
+"""
+
+import os
+import sys
+import time
+import asyncio
+import tempfile
+from collections import OrderedDict
+
+from expiringdict import ExpiringDict
+
+import metadata_cache
+from spotifyfs import SpotifyFS, NodeRegistry
+from batch_fetcher import BatchFetcher
+from single_flight import SingleFlight
+
+
+def rss_mb():
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1024 / 1024
+
+
+class BenchFS(SpotifyFS):
+    """
+    Just enough of SpotifyFS to list directories from its caches
+    """
+    def __init__(self, path):
+        self.cache = ExpiringDict(max_len=64*1024, max_age_seconds=3600)
+        self.metadata_cache = metadata_cache.MetadataCache(os.path.join(path, 'metadata.sqlite'))
+        self.content_fetches = SingleFlight()
+        self.country = 'us'
+        self.artists = BatchFetcher(self, 'artists', max_ids=50)
+        self.artistNodes = NodeRegistry()
+        self.albumNodes = NodeRegistry()
+        self.trackNodes = NodeRegistry()
+        self.max_materialized_dirs = 1024
+        self.materialized_dirs = OrderedDict()
+
+
+def fake_artist(i, num_albums):
+    return {
+        'id': f'artist{i}',
+        'name': f'Artist {i}',
+        'uri': f'spotify:artist:artist{i}',
+        'images': [{'url': f'https://example.com/artist{i}.jpg'}],
+        'related-artists': [],
+        'top-tracks': [],
+        'albuns': [
+            {'id': f'album{i}-{j}', 'name': f'Album {j}'}
+            for j in range(num_albums)
+        ],
+    }
+
+
+async def main(num_artists, num_albums):
+    with tempfile.TemporaryDirectory() as path:
+        fs = BenchFS(path)
+        artists = []
+        for i in range(num_artists):
+            artist = fs.getArtist(f'artist{i}')
+            fs.cache[artist.cache_id] = fake_artist(i, num_albums), time.time()
+            artists.append(artist)
+
+        rss_before = rss_mb()
+        start = time.perf_counter()
+        for artist in artists:
+            await artist.opendir()
+        elapsed = time.perf_counter() - start
+        rss_after = rss_mb()
+
+        print(f'{num_artists} artists x {num_albums} albums')
+        print(f'listing: {elapsed*1000/num_artists:.1f} ms/artist, {elapsed:.2f}s total')
+        print(f'RSS: {rss_before:.1f} MB -> {rss_after:.1f} MB ({rss_after - rss_before:+.1f} MB)')
+
+
+if __name__ == '__main__':
+    num_artists = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    num_albums = int(sys.argv[2]) if len(sys.argv) > 2 else 10000
+    asyncio.get_event_loop().run_until_complete(main(num_artists, num_albums))
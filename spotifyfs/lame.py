@@ -1,6 +1,8 @@
 from ctypes import *
 import numpy as np
 from enum import Enum
+from typing import Tuple
+from math import gcd
 
 class MpegMode(Enum):
     STEREO        = 0
@@ -146,10 +148,25 @@ class Lame:
         for k, v in kwargs.items():
             setattr(self, k, v)
 
+        # Number of samples (per channel) submitted on each call to lame_encode_buffer_interleaved
         self._max_encode_samples = 131072
-        self._write_buf_len = self._max_encode_samples * 5//4 + 7200
-        self._max_encode_samples = 15
-        self._write_buf = cast(create_string_buffer(self._write_buf_len), POINTER(c_byte))
+        self._write_buf_len = 0
+        self._grow_write_buf(self._max_encode_samples)
+
+
+    def _grow_write_buf(self, num_samples):
+        """
+        Makes sure the output buffer can hold the encoding of `num_samples`.
+
+        Worst case according to lame.h is 1.25*num_samples + 7200 for each call to lame_encode_buffer
+        """
+        num_slices = max(1, -(-num_samples // self._max_encode_samples))
+        size = num_samples * 5//4 + 7200 * num_slices
+        if size > self._write_buf_len:
+            self._write_buf_len = size
+            self._write_storage = bytearray(size)
+            self._write_buf = (c_byte * size).from_buffer(self._write_storage)
+            self._write_view = memoryview(self._write_storage)
 
 
     def __del__(self, **kwargs):
@@ -302,22 +319,31 @@ class Lame:
 
 
     def encode_buffer(self, buffer: np.ndarray) -> bytes:
+        """
+        Encodes interleaved stereo PCM.
+
+        All the MP3 data is written into the same reusable buffer, and copied out only once.
+        """
+        buffer = np.ascontiguousarray(buffer, np.int16)
         num_samples = len(buffer) // 2
-        buffer_ptr = buffer.ctypes.data_as(POINTER(c_short))
-        ret = b''
+        self._grow_write_buf(num_samples)
+
+        buffer_addr = buffer.ctypes.data
+        write_addr = addressof(self._write_buf)
+        write_pos = 0
         for slice_start in range(0, num_samples, self._max_encode_samples):
-            slice_ptr = cast(addressof(buffer_ptr.contents)+2*slice_start*sizeof(c_short), POINTER(c_short))
+            slice_ptr = cast(buffer_addr + 2*slice_start*sizeof(c_short), POINTER(c_short))
             slice_len = min(num_samples-slice_start, self._max_encode_samples)
 
             n = libmp3lame.lame_encode_buffer_interleaved(
                     self.lame,
                     slice_ptr, slice_len,
-                    self._write_buf,
-                    self._write_buf_len)
-            if n != 0:
-                chunk = string_at(self._write_buf, n)
-                ret = ret + chunk if ret is not None else chunk
-        return ret if ret is not None else b''
+                    cast(write_addr + write_pos, POINTER(c_byte)),
+                    self._write_buf_len - write_pos)
+            if n < 0:
+                raise RuntimeError('lame_encode_buffer_interleaved failed: %d' % n)
+            write_pos += n
+        return bytes(self._write_view[:write_pos])
 
 
     def encode_flush(self, nogap: bool = False) -> bytes:
@@ -332,7 +358,7 @@ class Lame:
         will also write id3v1 tags (if any) into the bitstream
         """
         n = libmp3lame.lame_encode_flush(self.lame, self._write_buf, self._write_buf_len)
-        return string_at(self._write_buf, n)
+        return bytes(self._write_view[:n])
 
 
     def encode_flush_nogap(self) -> bytes:
@@ -351,11 +377,118 @@ class Lame:
 
         This routine will NOT write id3v1 tags into the bitstream.
         """
-        n = libmp3lame.lame_encode_flush_nogap(self.lame, cast(self._write_buf, POINTER(c_byte)), self._write_buf_len)
-        return string_at(self._write_buf, n)
+        n = libmp3lame.lame_encode_flush_nogap(self.lame, self._write_buf, self._write_buf_len)
+        return bytes(self._write_view[:n])
+
+
+def cbr_frame_offset(frame: int, bitrate: int, sample_rate: int = 44100) -> int:
+    """
+    Offset of `frame` in a CBR MPEG-1 Layer III stream produced by LAME (Frame 0 is the Xing/Info frame).
+
+    Frames take 144000*bitrate/sample_rate bytes, rounded down, and LAME adds a padding byte to some
+    frames to make up for the fractional part: The Info frame and the first audio frame are never
+    padded, after that a frame is padded whenever the accumulated fraction reaches a whole byte.
+    """
+    frame_size, frac = divmod(144000 * bitrate, sample_rate)
+    padded = max(0, -(-(frame - 2) * frac // sample_rate))
+    return frame * frame_size + padded
+
+
+def cbr_padding_period(bitrate: int, sample_rate: int = 44100) -> int:
+    """
+    Number of frames after which the padding pattern of `cbr_frame_offset` repeats.
+
+    Two LAME streams have the same frame sizes if they start `cbr_padding_period` frames apart.
+    """
+    return sample_rate // gcd(144000 * bitrate % sample_rate, sample_rate)
+
+
+def cbr_stream_size(duration_ms: int, bitrate: int, sample_rate: int = 44100) -> int:
+    """
+    Size of a CBR MPEG-1 Layer III stream produced by LAME for `duration_ms` of audio, flushed with `encode_flush_nogap`.
+
+    Each frame holds 1152 samples, and the incomplete last frame isn't emitted. There is also
+    a Xing/Info frame at the start of the stream.
+
+    This is only as exact as `duration_ms`.
+    """
+    num_samples = duration_ms * sample_rate // 1000
+    return cbr_frame_offset(num_samples // 1152 + 1, bitrate, sample_rate)
+
+
+def cbr_frame_start(offset: int, bitrate: int, sample_rate: int = 44100) -> Tuple[int, int]:
+    """
+    Finds the frame of a CBR stream (As described in `cbr_frame_offset`) that contains byte `offset`.
+
+    Returns (frame number, offset of the frame).
+    """
+    frame = offset * sample_rate // (144000 * bitrate)
+    while frame > 0 and cbr_frame_offset(frame, bitrate, sample_rate) > offset:
+        frame -= 1
+    while cbr_frame_offset(frame + 1, bitrate, sample_rate) <= offset:
+        frame += 1
+    return frame, cbr_frame_offset(frame, bitrate, sample_rate)
+
+
+def _encode_buffer_sliced(encoder: Lame, buffer: np.ndarray, max_samples: int = 15) -> bytes:
+    """
+    The old encoding loop: Tiny slices, concatenating the output. Only used by the benchmark.
+    """
+    num_samples = len(buffer) // 2
+    buffer_ptr = buffer.ctypes.data_as(POINTER(c_short))
+    ret = b''
+    for slice_start in range(0, num_samples, max_samples):
+        slice_ptr = cast(addressof(buffer_ptr.contents)+2*slice_start*sizeof(c_short), POINTER(c_short))
+        slice_len = min(num_samples-slice_start, max_samples)
+
+        n = libmp3lame.lame_encode_buffer_interleaved(
+                encoder.lame,
+                slice_ptr, slice_len,
+                encoder._write_buf,
+                encoder._write_buf_len)
+        if n != 0:
+            ret = ret + string_at(encoder._write_buf, n)
+    return ret
+
+
+def benchmark(seconds=60, chunk_seconds=1):
+    """
+    Reports encoding speed, in samples/sec, of the old sliced loop and of `encode_buffer`
+    """
+    import time
+    import math
+
+    sample_rate = 44100
+    t = np.arange(sample_rate * chunk_seconds) / sample_rate
+    chunk = np.array([
+        30000 * np.cos(2*math.pi*440*t),
+        5000 * np.sin(2*math.pi*880*t),
+    ]).astype(np.int16).reshape([-1], order='F')
+    num_chunks = seconds // chunk_seconds
+
+    for name, encode in [
+            ('sliced (15 samples)', _encode_buffer_sliced),
+            ('encode_buffer', Lame.encode_buffer)]:
+        encoder = Lame(in_samplerate=sample_rate, num_channels=2, bitrate=256, write_id3tag_automatic=False)
+        encoder.init_params()
+
+        start = time.perf_counter()
+        size = 0
+        for i in range(num_chunks):
+            size += len(encode(encoder, chunk))
+        size += len(encoder.encode_flush_nogap())
+        elapsed = time.perf_counter() - start
+
+        samples = num_chunks * len(chunk) // 2
+        print('%-20s %12.0f samples/sec  (%d bytes in %.2fs)' % (name, samples / elapsed, size, elapsed))
 
 
 if __name__ == '__main__':
+    import sys
+    if sys.argv[1:2] == ['bench']:
+        benchmark()
+        sys.exit(0)
+
     encoder = Lame(num_samples=12, in_samplerate=44100, num_channels=2, scale=1.1, scale_left=.95, scale_right=.93, write_id3tag_automatic=True, compression_ratio=5, bitrate=500, quality=5)
     print(encoder.num_samples, encoder.in_samplerate, encoder.num_channels, encoder.scale, encoder.scale_left, encoder.scale_right, encoder.write_id3tag_automatic, encoder.bitrate, encoder.compression_ratio, encoder.mode, encoder.quality)
 
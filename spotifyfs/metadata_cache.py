@@ -0,0 +1,140 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import time
+import sqlite3
+
+from audio_cache import default_cache_dir
+
+
+class MetadataCache:
+    """
+    On-disk cache of the content of SpotifyDirs and of the Web API responses, shared across mounts.
+
+    Directory content expires after a TTL that depends on the node type (Album tracklists
+    basically never change, the list of followed artists might change any minute).
+
+    API responses are stored with their ETag, so that they can be revalidated with `If-None-Match`.
+
+    This runs on the event loop, so writes don't wait for the disk: The database is in WAL mode
+    without a sync on every commit, and writes are only committed every `commit_interval` seconds
+    (By the next write or by `maintain()`). Responses older than `max_response_age` are pruned
+    every `prune_interval` seconds.
+    """
+
+    DEFAULT_TTLS = {
+        'FollowedArtistsNode': 600,
+        'ArtistNode': 24*3600,
+        'AlbumNode': 30*24*3600,
+    }
+
+    def __init__(self, path=None, ttls=None, default_ttl=3600, max_response_age=30*24*3600,
+                 commit_interval=5, prune_interval=3600):
+        path = path or default_cache_dir('metadata.sqlite')
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        self.ttls = dict(self.DEFAULT_TTLS)
+        if ttls is not None:
+            self.ttls.update(ttls)
+        self.default_ttl = default_ttl
+        self.max_response_age = max_response_age
+        self.commit_interval = commit_interval
+        self.prune_interval = prune_interval
+
+        self.db = sqlite3.connect(path)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS content (key TEXT PRIMARY KEY, value TEXT, fetched_at REAL)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS responses (url TEXT PRIMARY KEY, etag TEXT, value TEXT, fetched_at REAL)')
+        self.db.commit()
+
+        self.dirty = False
+        self.committed_at = time.monotonic()
+        self.pruned_at = None
+        self.prune()
+
+    def _written(self):
+        self.dirty = True
+        if time.monotonic() - self.committed_at >= self.commit_interval:
+            self.flush()
+
+    def flush(self):
+        """
+        Commits pending writes
+        """
+        if self.dirty:
+            self.db.commit()
+            self.dirty = False
+        self.committed_at = time.monotonic()
+
+    def prune(self):
+        """
+        Drops responses that are too old to be worth revalidating
+        """
+        self.db.execute('DELETE FROM responses WHERE fetched_at < ?', (time.time() - self.max_response_age,))
+        self.db.commit()
+        self.pruned_at = time.monotonic()
+
+    def maintain(self):
+        """
+        Called periodically while mounted: Commits pending writes, and prunes old responses when due
+        """
+        self.flush()
+        if time.monotonic() - self.pruned_at >= self.prune_interval:
+            self.prune()
+
+    @staticmethod
+    def _key(cache_id):
+        return json.dumps(list(cache_id))
+
+    def ttl(self, cache_id):
+        return self.ttls.get(cache_id[0], self.default_ttl)
+
+    def get_entry(self, cache_id):
+        """
+        Returns (content, age in seconds), even if it has expired, or None if it isn't cached
+        """
+        row = self.db.execute('SELECT value, fetched_at FROM content WHERE key = ?', (self._key(cache_id),)).fetchone()
+        if row is None:
+            return None
+        value, fetched_at = row
+        return json.loads(value), time.time() - fetched_at
+
+    def touch(self, cache_id):
+        """
+        The content has been revalidated and is fresh again
+        """
+        self.db.execute('UPDATE content SET fetched_at = ? WHERE key = ?', (time.time(), self._key(cache_id)))
+        self._written()
+
+    def set(self, cache_id, value):
+        self.db.execute(
+                'INSERT OR REPLACE INTO content (key, value, fetched_at) VALUES (?, ?, ?)',
+                (self._key(cache_id), json.dumps(value), time.time()))
+        self._written()
+
+    def delete(self, cache_id):
+        self.db.execute('DELETE FROM content WHERE key = ?', (self._key(cache_id),))
+        self._written()
+
+    def get_response(self, url):
+        """
+        Returns (etag, value) of the last response to `url`, or None
+        """
+        row = self.db.execute('SELECT etag, value FROM responses WHERE url = ?', (url,)).fetchone()
+        if row is None:
+            return None
+        etag, value = row
+        return etag, json.loads(value)
+
+    def set_response(self, url, etag, value):
+        self.db.execute(
+                'INSERT OR REPLACE INTO responses (url, etag, value, fetched_at) VALUES (?, ?, ?, ?)',
+                (url, etag, json.dumps(value), time.time()))
+        self._written()
+
+    def close(self):
+        self.flush()
+        self.db.close()
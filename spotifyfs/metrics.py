@@ -0,0 +1,228 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import time
+import bisect
+import functools
+import threading
+from contextlib import contextmanager
+
+
+DEFAULT_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30)
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    def escape(value):
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return '{' + ','.join(f'{name}="{escape(value)}"' for name, value in pairs) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    type = None
+
+    def __init__(self, registry, name, help, labels=()):
+        self.registry = registry
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self.values = {}
+
+    def _key(self, labels):
+        # Label values are always strings, so that keys can be sorted when rendering
+        return tuple(str(labels.get(name, '')) for name in self.label_names)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.type}']
+        for key in sorted(self.values):
+            lines.extend(self._render_value(key, self.values[key]))
+        return lines
+
+
+class Counter(Metric):
+    """
+    Monotonically increasing value, eg: Number of requests
+    """
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.registry.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def get(self, **labels):
+        return self.values.get(self._key(labels), 0)
+
+    def _render_value(self, key, value):
+        yield f'{self.name}{_format_labels(self.label_names, key)} {_format_value(value)}'
+
+
+class Gauge(Metric):
+    """
+    Value that is sampled when the metrics are rendered
+    """
+    type = 'gauge'
+
+    def __init__(self, registry, name, help, func):
+        super().__init__(registry, name, help)
+        self.func = func
+
+    def render(self):
+        self.values = {(): self.func()}
+        return super().render()
+
+    def _render_value(self, key, value):
+        yield f'{self.name} {_format_value(value)}'
+
+
+class Histogram(Metric):
+    """
+    Distribution of observed values, eg: Latencies, in seconds
+    """
+    type = 'histogram'
+
+    def __init__(self, registry, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(registry, name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self.registry.lock:
+            state = self.values.get(key)
+            if state is None:
+                state = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            state[0][bisect.bisect_left(self.buckets, value)] += 1
+            state[1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - start, **labels)
+
+    def _render_value(self, key, state):
+        counts, total = state
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            cumulative += count
+            yield f'{self.name}_bucket{_format_labels(self.label_names, key, [("le", _format_value(bound))])} {cumulative}'
+        yield f'{self.name}_sum{_format_labels(self.label_names, key)} {_format_value(total)}'
+        yield f'{self.name}_count{_format_labels(self.label_names, key)} {cumulative}'
+
+
+class Registry:
+    """
+    Collection of metrics, rendered in the Prometheus text format.
+
+    Metrics can be updated from any thread (LAME encoding runs on the playback workers' threads).
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = {}
+
+    def _add(self, metric):
+        if metric.name in self.metrics:
+            return self.metrics[metric.name]
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help, labels=()):
+        return self._add(Counter(self, name, help, labels))
+
+    def histogram(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        return self._add(Histogram(self, name, help, labels, buckets))
+
+    def gauge(self, name, help, func):
+        return self._add(Gauge(self, name, help, func))
+
+    def render(self):
+        with self.lock:
+            lines = []
+            for metric in self.metrics.values():
+                lines.extend(metric.render())
+            return '\n'.join(lines) + '\n'
+
+
+# Shared by the whole filesystem
+registry = Registry()
+
+api_requests = registry.counter(
+        'spotifyfs_api_requests_total', 'Spotify Web API requests', ['endpoint', 'method', 'status'])
+api_latency = registry.histogram(
+        'spotifyfs_api_request_seconds', 'Spotify Web API request latency', ['endpoint', 'method'])
+content_cache = registry.counter(
+        'spotifyfs_content_cache_total', 'Lookups of the in-memory content cache', ['result'])
+content_cache_ratio = registry.gauge(
+        'spotifyfs_content_cache_hit_ratio', 'Fraction of content cache lookups that were hits',
+        lambda: content_cache.get(result='hit') / max(1, content_cache.get(result='hit') + content_cache.get(result='miss')))
+playback_streams = registry.counter(
+        'spotifyfs_playback_streams_total', 'Track streams opened', ['source'])
+playback_wait = registry.histogram(
+        'spotifyfs_playback_queue_wait_seconds', 'Time spent waiting for a playback worker', ['priority'],
+        buckets=(.01, .1, .5, 1, 2.5, 5, 10, 30, 60, 120, 300))
+playback_bytes = registry.counter(
+        'spotifyfs_playback_encoded_bytes_total', 'MP3 bytes produced by the playback workers')
+playback_stream_seconds = registry.histogram(
+        'spotifyfs_playback_stream_seconds', 'Time taken to encode a whole track',
+        buckets=(1, 2.5, 5, 10, 20, 30, 60, 120, 300, 600))
+encode_chunk_seconds = registry.histogram(
+        'spotifyfs_lame_encode_chunk_seconds', 'LAME encode time per PCM chunk',
+        buckets=(.0001, .00025, .0005, .001, .0025, .005, .01, .025, .05, .1))
+fuse_latency = registry.histogram(
+        'spotifyfs_fuse_op_seconds', 'Latency of FUSE operations', ['op'])
+
+
+def timed(histogram, **labels):
+    """
+    Decorator that records how long each call to an async function takes
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            with histogram.time(**labels):
+                return await func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def api_endpoint(path):
+    """
+    Collapses Spotify ids out of an API path, so that `/v1/artists/<id>/albums` is a single endpoint
+    """
+    parts = []
+    for part in path.split('?', 1)[0].strip('/').split('/'):
+        if parts and parts[-1] in ('artists', 'albums', 'tracks', 'playlists', 'users', 'shows', 'episodes') and part:
+            parts.append(':id')
+        else:
+            parts.append(part)
+    return '/' + '/'.join(parts)
+
+
+async def serve(port, host='127.0.0.1', registry=registry):
+    """
+    Exposes the metrics on http://host:port/metrics
+    """
+    from aiohttp import web
+
+    async def handle(request):
+        return web.Response(text=registry.render(), content_type='text/plain', charset='utf-8')
+
+    app = web.Application()
+    app.router.add_get('/metrics', handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+    print(f'Metrics available on http://{host}:{port}/metrics')
+    return runner
@@ -0,0 +1,74 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import time
+import asyncio
+import itertools
+
+import metrics
+
+
+PRIORITY_INTERACTIVE = 0  # Someone is waiting on a read
+PRIORITY_PREFETCH = 1     # Speculative / background playback
+
+PRIORITY_NAMES = {
+    PRIORITY_INTERACTIVE: 'interactive',
+    PRIORITY_PREFETCH: 'prefetch',
+}
+
+
+class PlaybackScheduler:
+    """
+    Hands free PlaybackWorkers to waiting streams, lowest priority value first.
+
+    Waiting streams age: Every `aging` seconds in the queue count as one priority level,
+    so background jobs are not starved by a constant flow of interactive reads.
+    """
+
+    class Ticket:
+        def __init__(self, priority, seq):
+            self.priority = priority
+            self.seq = seq
+            self.enqueued = time.monotonic()
+            self.future = asyncio.get_event_loop().create_future()
+
+    def __init__(self, workers, aging=60.0):
+        self.free = list(workers)
+        self.waiting = []
+        self.aging = aging
+        self.seq = itertools.count()
+
+    def enqueue(self, priority):
+        ticket = PlaybackScheduler.Ticket(priority, next(self.seq))
+        self.waiting.append(ticket)
+        self._dispatch()
+        return ticket
+
+    def boost(self, ticket, priority):
+        if priority < ticket.priority:
+            ticket.priority = priority
+
+    async def wait(self, ticket):
+        try:
+            return await asyncio.shield(ticket.future)
+        except asyncio.CancelledError:
+            if ticket in self.waiting:
+                self.waiting.remove(ticket)
+            elif ticket.future.done() and not ticket.future.cancelled():
+                self.release(ticket.future.result())
+            raise
+
+    def release(self, worker):
+        self.free.append(worker)
+        self._dispatch()
+
+    def _dispatch(self):
+        while self.free and self.waiting:
+            now = time.monotonic()
+            ticket = min(self.waiting, key=lambda t: (t.priority - (now - t.enqueued) / self.aging, t.seq))
+            self.waiting.remove(ticket)
+
+            # Queue wait time per priority class
+            metrics.playback_wait.observe(now - ticket.enqueued, priority=PRIORITY_NAMES.get(ticket.priority, 'prefetch'))
+
+            ticket.future.set_result(self.free.pop())
@@ -0,0 +1,100 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import json
+import time
+import random
+import asyncio
+import aiohttp
+
+from single_flight import SingleFlight
+
+
+class TokenBucket:
+    """
+    Allows `rate` operations per second on average, with bursts of up to `burst` operations
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = time.monotonic()
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class RequestScheduler:
+    """
+    All requests to the Web API go through here:
+    - A token bucket and a concurrency limit keep us below Spotify's rate limit;
+    - On 429, every request waits for `Retry-After` seconds;
+    - 5xx and connection errors are retried with exponential backoff;
+    - Identical GET requests in flight are coalesced into a single request.
+    """
+
+    def __init__(self, rate=10, burst=20, max_concurrency=8, max_retries=5, backoff=0.5):
+        self.bucket = TokenBucket(rate, burst)
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.paused_until = 0
+        self.in_flight = SingleFlight()
+
+    async def request(self, session, method, url, **kwargs):
+        """
+        Returns (status, headers, json)
+
+        Raises aiohttp.ClientResponseError if the request failed, 304 is not considered an error.
+        """
+        if method != 'GET':
+            return await self._request(session, method, url, **kwargs)
+
+        key = (url, json.dumps(kwargs.get('params'), sort_keys=True), (kwargs.get('headers') or {}).get('If-None-Match'))
+        return await self.in_flight.run(key, self._request, session, method, url, **kwargs)
+
+    async def _wait_turn(self):
+        while True:
+            delay = self.paused_until - time.monotonic()
+            if delay <= 0:
+                break
+            await asyncio.sleep(delay)
+        await self.bucket.acquire()
+
+    async def _request(self, session, method, url, **kwargs):
+        for attempt in range(self.max_retries + 1):
+            retry = attempt < self.max_retries
+            delay = self.backoff * 2**attempt * (1 + random.random())
+
+            await self._wait_turn()
+            try:
+                async with self.semaphore:
+                    async with session.request(method=method, url=url, **kwargs) as response:
+                        if response.status == 429 and retry:
+                            retry_after = float(response.headers.get('Retry-After', delay))
+                            print(f'Rate limited, waiting {retry_after}s')
+                            self.paused_until = max(self.paused_until, time.monotonic() + retry_after)
+                            continue
+
+                        if response.status >= 500 and retry:
+                            print(f'{url} failed with {response.status}, retrying in {delay:.1f}s')
+                        else:
+                            response.raise_for_status()
+                            data = None if response.status == 304 else await response.json()
+                            return response.status, response.headers, data
+            except aiohttp.ClientResponseError:
+                raise
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                if not retry:
+                    raise
+                print(f'{url} failed with {e!r}, retrying in {delay:.1f}s')
+
+            await asyncio.sleep(delay)
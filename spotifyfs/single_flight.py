@@ -0,0 +1,30 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import asyncio
+
+
+class SingleFlight:
+    """
+    Concurrent calls with the same key share a single execution.
+
+    The shared task isn't cancelled when one of the callers is.
+    """
+
+    def __init__(self):
+        self.pending = {}
+
+    async def run(self, key, func, *args, **kwargs):
+        future = self.pending.get(key, None)
+        if future is None:
+            future = asyncio.ensure_future(func(*args, **kwargs))
+            self.pending[key] = future
+
+            def done(f):
+                if self.pending.get(key, None) is f:
+                    del self.pending[key]
+            future.add_done_callback(done)
+        return await asyncio.shield(future)
+
+    def __contains__(self, key):
+        return key in self.pending
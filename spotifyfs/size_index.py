@@ -0,0 +1,42 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import os
+import dbm
+import json
+
+from audio_cache import default_cache_dir
+
+
+class SizeIndex:
+    """
+    Persistent record of the real size of each track file, keyed by track id and bitrate.
+
+    Values are the sizes of the 3 parts of the file: (ID3v2, MP3 audio, ID3v1)
+    """
+
+    def __init__(self, path=None):
+        path = path or default_cache_dir('sizes')
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.db = dbm.open(path, 'c')
+
+    @staticmethod
+    def key(track_id, bitrate):
+        return f'{track_id}:{bitrate}'
+
+    def get(self, track_id, bitrate):
+        try:
+            return tuple(json.loads(self.db[self.key(track_id, bitrate)]))
+        except KeyError:
+            return None
+
+    def set(self, track_id, bitrate, id3v2_size, audio_size, id3v1_size):
+        value = json.dumps([id3v2_size, audio_size, id3v1_size])
+        key = self.key(track_id, bitrate)
+        if self.db.get(key) != value.encode('utf-8'):
+            self.db[key] = value
+            if hasattr(self.db, 'sync'):
+                self.db.sync()
+
+    def close(self):
+        self.db.close()
@@ -9,6 +9,7 @@ import spotipy.util
 
 from expiringdict import ExpiringDict
 from functools import partial
+from collections import OrderedDict
 from stat import S_IFDIR, S_IFLNK, S_IFREG
 
 import asyncio
@@ -18,11 +19,22 @@ import inspect
 import sys
 import json
 import errno
+import weakref
+import time
+import traceback
 
 import fuse
 import fusetree
 import logging
 import audio_fetch
+import audio_cache
+import size_index
+import metadata_cache
+import request_scheduler
+import metrics
+from batch_fetcher import BatchFetcher
+from single_flight import SingleFlight
+from lame import cbr_stream_size
 
 FILE_MODE = S_IFREG | 0o444
 FILE_MODE_RW = S_IFREG | 0o666
@@ -35,11 +47,130 @@ SPOTIFY_CLIENT_SECRET='822d085d81af4aae9ad800609dcc3706'
 def escape_filename(name):
     return name.replace('/', '∕')
 
+
+def merge_files(files, new_files):
+    """
+    Updates a directory listing in place, keeping the entries (and nested folders) that didn't change
+    """
+    for name in list(files.keys()):
+        if name not in new_files:
+            del files[name]
+    for name, node in new_files.items():
+        old_node = files.get(name, None)
+        if isinstance(old_node, dict) and isinstance(node, dict):
+            merge_files(old_node, node)
+        elif old_node is not node:
+            files[name] = node
+
+
+def _syncsafe(data):
+    return (data[0] << 21) | (data[1] << 14) | (data[2] << 7) | data[3]
+
+
+def _to_syncsafe(n):
+    return bytes([(n >> 21) & 0x7f, (n >> 14) & 0x7f, (n >> 7) & 0x7f, n & 0x7f])
+
+
+def add_id3_frame(tag, frame):
+    """
+    Inserts a raw frame right after the header of an ID3v2 tag, fixing its size
+    """
+    size = _syncsafe(tag[6:10]) + len(frame)
+    return tag[:6] + _to_syncsafe(size) + frame + tag[10:]
+
+
+class NodeRegistry:
+    """
+    Maps ids to nodes, without keeping every node ever created alive.
+
+    Nodes are held by weak references, so a node stays registered while anything else
+    uses it (Its parent directory, an open file handle, FUSE). The `max_len` most recently
+    used nodes are also kept alive by the registry itself.
+    """
+
+    def __init__(self, max_len=4096):
+        self.nodes = weakref.WeakValueDictionary()
+        self.recent = OrderedDict()
+        self.max_len = max_len
+
+    def __getitem__(self, key):
+        node = self.nodes[key]
+        self._touch(key, node)
+        return node
+
+    def __setitem__(self, key, node):
+        self.nodes[key] = node
+        self._touch(key, node)
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def _touch(self, key, node):
+        self.recent[key] = node
+        self.recent.move_to_end(key)
+        while len(self.recent) > self.max_len:
+            self.recent.popitem(last=False)
+
 class SpotifyFS(fusetree.DictDir):
-    def __init__(self, country='us'):
+    def __init__(self, country='us',
+                 audio_cache_dir=None, audio_cache_size=2*1024*1024*1024,
+                 playback_workers=2, stream_memory_limit=256*1024*1024, seekable_streams=False,
+                 metadata_cache_path=None, metadata_ttls=None,
+                 api_rate=10, api_concurrency=8,
+                 prefetch_tracks=0, prefetch_at=0.5, linger_time=10, linger_max=16,
+                 warmup_depth=0, warmup_concurrency=4, warmup_tracks=False,
+                 id3_cover=True, max_nodes=4096, max_materialized_dirs=1024,
+                 max_stale=7*24*3600, refresh_retry=60, metrics_port=None):
         # There is a massive performance gain if we cache a directory's contents.
         self.cache = ExpiringDict(max_len=64*1024, max_age_seconds=3600)
+        # ... And keep it on disk, so that the next mount starts warm
+        self.metadata_cache = metadata_cache.MetadataCache(metadata_cache_path, metadata_ttls)
+        # Concurrent lookups of the same directory share a single fetch
+        self.content_fetches = SingleFlight()
+        # Expired content is still served for up to `max_stale` seconds, while it gets refreshed in background.
+        # A directory whose refresh failed isn't refreshed again for `refresh_retry` seconds.
+        self.max_stale = max_stale
+        self.refresh_retry = refresh_retry
         self.country = country
+        self.api_rate = api_rate
+        self.api_concurrency = api_concurrency
+
+        # Encoded tracks are kept on disk, so opening a file again doesn't stream it again
+        self.audio_cache = audio_cache.AudioCache(audio_cache_dir, audio_cache_size) if audio_cache_size else None
+        self.playback_workers = playback_workers
+        self.stream_memory_limit = stream_memory_limit
+        self.seekable_streams = seekable_streams
+
+        # While reading a track from an album, encode the next `prefetch_tracks` in background
+        # once `prefetch_at` of the current track has been read
+        self.prefetch_tracks = prefetch_tracks
+        self.prefetch_at = prefetch_at
+
+        # Track handles are kept open for `linger_time` seconds after being released,
+        # so that reopening the file reuses the stream. At most `linger_max` of them.
+        self.linger_time = linger_time
+        self.linger_max = linger_max
+        self.lingering = OrderedDict()
+
+        # Real file sizes of tracks that have been fully read
+        self.size_index = size_index.SizeIndex()
+
+        # Generated tags, per track, and cover images (As ID3 frames), per album.
+        # Tags are cached without the cover, which is only added when they are served.
+        self.id3_cover = id3_cover
+        self.id3_cache = ExpiringDict(max_len=16*1024, max_age_seconds=24*3600)
+        self.cover_cache = ExpiringDict(max_len=256, max_age_seconds=24*3600)
+        self.tag_builds = SingleFlight()
+
+        # Crawl the tree in background after mounting, so that the metadata cache is warm
+        self.warmup_depth = warmup_depth
+        self.warmup_concurrency = warmup_concurrency
+        self.warmup_tracks = warmup_tracks
+        self.warmup = WarmupCrawler(self)
+
+        # Metrics are always readable on `.stats`, and also served over HTTP if `metrics_port` is set
+        self.metrics_port = metrics_port
+        self.metrics_server = None
 
         #FIXME -- Don't rely on spotipy and copy-pasting for authentication
         self.token = spotipy.util.prompt_for_user_token(
@@ -49,12 +180,23 @@ class SpotifyFS(fusetree.DictDir):
             client_secret=SPOTIFY_CLIENT_SECRET,
             redirect_uri='https://example.com')
 
-        self.artistNodes = {}
-        self.albumNodes = {}
-        self.trackNodes = {}
+        # Single-object lookups get batched into the multi-id endpoints
+        self.artists = BatchFetcher(self, 'artists', max_ids=50)
+        self.albums = BatchFetcher(self, 'albums', max_ids=20, params={'market': country})
+        self.tracks = BatchFetcher(self, 'tracks', max_ids=50, params={'market': country})
+
+        self.artistNodes = NodeRegistry(max_nodes)
+        self.albumNodes = NodeRegistry(max_nodes)
+        self.trackNodes = NodeRegistry(max_nodes)
         self.playlistNodes = {}
 
-        fusetree.DictDir.__init__(self, {
+        # Directories that have built their file list. The least recently used drop it.
+        self.max_materialized_dirs = max_materialized_dirs
+        self.materialized_dirs = OrderedDict()
+
+        self.root_files = {
+            '.warmup': WarmupControlNode(self),
+            '.stats': StatsNode(),
             'Artists': FollowedArtistsNode(self, id=None, mode=DIR_MODE_RW),
             #'Playlists': UserPlaylistsNode(self, id='me', mode=DIR_MODE_RW),
             #'Saved Albums': {},
@@ -66,25 +208,107 @@ class SpotifyFS(fusetree.DictDir):
             #'Featured Playlists': {},
             #'New Releases': {},
             #'Recommendations': {},
-        })
+        }
+        fusetree.DictDir.__init__(self, self.root_files)
 
     async def remember(self):
         self.aiohttp_session = aiohttp.ClientSession(loop=asyncio.get_event_loop())
-        self.audio_fetch = audio_fetch.SpotifyAudioFetcher(loop=asyncio.get_event_loop())
+        self.request_scheduler = request_scheduler.RequestScheduler(
+                rate=self.api_rate,
+                burst=2*self.api_rate,
+                max_concurrency=self.api_concurrency)
+        self.audio_fetch = audio_fetch.SpotifyAudioFetcher(
+                loop=asyncio.get_event_loop(),
+                audio_cache=self.audio_cache,
+                num_workers=self.playback_workers,
+                memory_limit=self.stream_memory_limit,
+                seekable=self.seekable_streams)
+
+        if self.warmup_depth > 0:
+            await self.warmup.start(self.warmup_depth)
+        if self.metrics_port is not None:
+            self.metrics_server = await metrics.serve(self.metrics_port)
+        self.metadata_maintenance = asyncio.ensure_future(self.maintain_metadata_cache())
 
     async def forget(self) -> None:
+        if self.metrics_server is not None:
+            await self.metrics_server.cleanup()
+        self.metadata_maintenance.cancel()
+        self.metadata_cache.close()
         await self.aiohttp_session.close()
 
+    async def maintain_metadata_cache(self):
+        while True:
+            await asyncio.sleep(self.metadata_cache.commit_interval)
+            try:
+                self.metadata_cache.maintain()
+            except:
+                traceback.print_exc()
+
     async def request(self, url, method='GET', **kwargs):
         url = urllib.parse.urljoin('https://api.spotify.com/v1/', url)
-        response = await self.aiohttp_session.request(url=url, headers={'Authorization': f'Bearer {self.token}'}, method=method, **kwargs)
-        return await response.json()
+        headers = {'Authorization': f'Bearer {self.token}'}
+
+        # Revalidate previous responses with their ETag
+        cached = None
+        if method == 'GET':
+            cache_url = url
+            if kwargs.get('params'):
+                cache_url += ('&' if '?' in url else '?') + urllib.parse.urlencode(sorted(kwargs['params'].items()))
+            cached = self.metadata_cache.get_response(cache_url)
+            if cached is not None:
+                headers['If-None-Match'] = cached[0]
+
+        endpoint = metrics.api_endpoint(urllib.parse.urlparse(url).path[len('/v1'):])
+        try:
+            with metrics.api_latency.time(endpoint=endpoint, method=method):
+                status, response_headers, ret = await self.request_scheduler.request(
+                        self.aiohttp_session, method, url, headers=headers, **kwargs)
+        except aiohttp.ClientResponseError as e:
+            metrics.api_requests.inc(endpoint=endpoint, method=method, status=e.status)
+            raise
+        except:
+            metrics.api_requests.inc(endpoint=endpoint, method=method, status='error')
+            raise
+        metrics.api_requests.inc(endpoint=endpoint, method=method, status=status)
+        if status == 304 and cached is not None:
+            return cached[1]
+
+        etag = response_headers.get('ETag')
+        if method == 'GET' and etag is not None and status == 200:
+            self.metadata_cache.set_response(cache_url, etag, ret)
+        return ret
 
-    async def request_list(self, path, key=None, **kwargs):
+    async def request_list(self, path, key=None, max_concurrency=8, **kwargs):
         it = await self.request(path, **kwargs)
         if key is not None:
             it = it[key]
-        items = it['items']
+        # Coalesced requests share the same response, it must not be modified
+        items = list(it['items'])
+
+        # Offset-paginated: The first page tells how many pages there are, fetch all of them at once
+        if it['next'] and 'cursors' not in it and it.get('total') is not None and it.get('limit'):
+            next_url = urllib.parse.urlparse(it['next'])
+            query = dict(urllib.parse.parse_qsl(next_url.query))
+            semaphore = asyncio.Semaphore(max_concurrency)
+
+            async def fetch_page(offset):
+                page_url = next_url._replace(query=urllib.parse.urlencode({**query, 'offset': offset})).geturl()
+                async with semaphore:
+                    page = await self.request(page_url)
+                if key is not None:
+                    page = page[key]
+                return page['items']
+
+            pages = await asyncio.gather(*[
+                fetch_page(offset)
+                for offset in range(it['offset'] + it['limit'], it['total'], it['limit'])
+            ])
+            for page in pages:
+                items += page
+            return items
+
+        # Cursor-paginated: Follow the links one by one
         while it['next']:
             it = await self.request(it['next'])
             if key is not None:
@@ -92,6 +316,35 @@ class SpotifyFS(fusetree.DictDir):
             items += it['items']
         return items
 
+    def linger(self, handle):
+        """
+        Closes a released track handle after `linger_time`, unless it gets reopened before that
+        """
+        loop = asyncio.get_event_loop()
+        self.unlinger(handle)
+        self.lingering[handle] = loop.call_later(self.linger_time, lambda: asyncio.ensure_future(self._linger_expired(handle)))
+
+        while len(self.lingering) > self.linger_max:
+            oldest, timer = self.lingering.popitem(last=False)
+            timer.cancel()
+            asyncio.ensure_future(oldest.close())
+
+    def unlinger(self, handle):
+        timer = self.lingering.pop(handle, None)
+        if timer is not None:
+            timer.cancel()
+
+    async def _linger_expired(self, handle):
+        if self.lingering.pop(handle, None) is not None:
+            await handle.close()
+
+    def touch_dir(self, node):
+        self.materialized_dirs[node.cache_id] = node
+        self.materialized_dirs.move_to_end(node.cache_id)
+        while len(self.materialized_dirs) > self.max_materialized_dirs:
+            key, oldest = self.materialized_dirs.popitem(last=False)
+            oldest.drop_files()
+
     def getArtist(self, id):
         try:
             return self.artistNodes[id]
@@ -124,23 +377,280 @@ class SpotifyFS(fusetree.DictDir):
             self.trackNodes[id] = trackNode
             return trackNode
 
+class WarmupCrawler:
+    """
+    Walks a subtree in background, with bounded concurrency, so that its content
+    gets into the metadata cache before anyone looks at it.
+    """
+
+    def __init__(self, spotifyfs):
+        self.spotifyfs = spotifyfs
+        self.task = None
+        self.path = None
+        self.depth = 0
+        self.visited = 0
+        self.queued = 0
+        self.errors = 0
+        self.failure = None
+
+    @property
+    def running(self):
+        return self.task is not None and not self.task.done()
+
+    def status(self) -> str:
+        state = 'running' if self.running else 'failed' if self.failure else 'idle'
+        return inspect.cleandoc(f"""
+            state: {state}
+            path: {self.path or ''}
+            depth: {self.depth}
+            visited: {self.visited}
+            queued: {self.queued}
+            errors: {self.errors}
+            failure: {self.failure or ''}
+            """) + '\n'
+
+    async def resolve(self, path):
+        node = self.spotifyfs.root_files
+        for name in filter(None, path.split('/')):
+            if isinstance(node, dict):
+                node = node.get(name, None)
+            else:
+                node = await node.lookup(name)
+            if node is None:
+                raise fuse.FuseOSError(errno.ENOENT)
+        return node
+
+    async def start(self, depth, path=''):
+        """
+        Starts crawling `path` in background. Raises ENOENT right away if it doesn't exist.
+        """
+        root = await self.resolve(path)
+        if self.running:
+            self.task.cancel()
+        self.path = path
+        self.depth = depth
+        self.visited = self.queued = self.errors = 0
+        self.failure = None
+        self.task = asyncio.ensure_future(self.run(depth, root, path))
+
+    async def run(self, depth, root, path):
+        try:
+            await self.crawl(depth, root, path)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.failure = repr(e)
+            print(f'Warm-up of /{path} failed')
+            traceback.print_exc()
+
+    async def crawl(self, depth, root, path=''):
+        queue = asyncio.Queue()
+        seen = set()
+
+        def enqueue(node, depth):
+            key = getattr(node, 'cache_id', None) or id(node)
+            if key not in seen:
+                seen.add(key)
+                self.queued += 1
+                queue.put_nowait((node, depth))
+
+        async def visit(node, depth):
+            if isinstance(node, TrackNode):
+                if self.spotifyfs.warmup_tracks:
+                    await node.id3()
+                return
+
+            if isinstance(node, dict):
+                children = node
+            elif isinstance(node, SpotifyDir):
+                children = await node.files()
+            else:
+                return
+
+            for child in children.values():
+                if isinstance(child, dict):
+                    enqueue(child, depth)  # Grouping folders don't count as a level
+                elif depth > 0 and isinstance(child, (SpotifyDir, TrackNode)):
+                    enqueue(child, depth - 1)
+
+        async def worker():
+            while True:
+                node, depth = await queue.get()
+                try:
+                    await visit(node, depth)
+                except asyncio.CancelledError:
+                    raise
+                except:
+                    self.errors += 1
+                finally:
+                    self.visited += 1
+                    queue.task_done()
+                    if self.visited % 100 == 0:
+                        print(f'Warm-up: {self.visited}/{self.queued} nodes visited')
+
+        print(f'Warm-up of /{path} started, depth={depth}')
+        enqueue(root, depth)
+        workers = [asyncio.ensure_future(worker()) for i in range(self.spotifyfs.warmup_concurrency)]
+        try:
+            await queue.join()
+        finally:
+            for w in workers:
+                w.cancel()
+        print(f'Warm-up of /{path} finished: {self.visited} nodes visited, {self.errors} errors')
+
+
+class WarmupControlNode(fusetree.Node):
+    """
+    `.warmup` control file
+
+    Reading it shows the crawler progress.
+    Writing `<depth> [path]` to it starts crawling `path` (The whole tree by default).
+    """
+
+    def __init__(self, spotifyfs):
+        self.spotifyfs = spotifyfs
+
+    async def getattr(self) -> fusetree.Stat:
+        return fusetree.Stat(
+            st_mode = FILE_MODE_RW,
+            st_size = len(self.spotifyfs.warmup.status().encode('utf-8'))
+        )
+
+    async def truncate(self, length: int) -> None:
+        pass
+
+    async def open(self, mode):
+        return WarmupControlNode.Handle(self)
+
+    class Handle (fusetree.FileHandle):
+        def __init__(self, node):
+            super().__init__(node, direct_io=True)
+
+        async def read(self, size: int, offset: int) -> bytes:
+            return self.node.spotifyfs.warmup.status().encode('utf-8')[offset:offset+size]
+
+        async def write(self, buffer: bytes, offset: int) -> int:
+            try:
+                args = buffer.decode('utf-8').strip().split(None, 1)
+                depth = int(args[0])
+                path = args[1] if len(args) > 1 else ''
+            except (UnicodeDecodeError, IndexError, ValueError):
+                raise fuse.FuseOSError(errno.EINVAL)
+            await self.node.spotifyfs.warmup.start(depth, path)
+            return len(buffer)
+
+        async def truncate(self, length: int) -> None:
+            pass
+
+
+class StatsNode(fusetree.Node):
+    """
+    `.stats` file, with the metrics in the Prometheus text format.
+
+    The content is rendered again on every open, and stays the same while that handle is open.
+    """
+
+    async def getattr(self) -> fusetree.Stat:
+        return fusetree.Stat(
+            st_mode = FILE_MODE,
+            st_size = len(metrics.registry.render().encode('utf-8'))
+        )
+
+    async def open(self, mode):
+        return StatsNode.Handle(self)
+
+    class Handle (fusetree.FileHandle):
+        def __init__(self, node):
+            super().__init__(node, direct_io=True)
+            self.data = metrics.registry.render().encode('utf-8')
+
+        async def read(self, size: int, offset: int) -> bytes:
+            return self.data[offset:offset+size]
+
+
+class SyntheticFile(fusetree.Node):
+    """
+    Read-only file whose content is only generated when someone looks at it
+    """
+    __slots__ = ('generate', '_data')
+
+    def __init__(self, generate: Callable[[], str]):
+        self.generate = generate
+        self._data = None
+
+    def data(self) -> bytes:
+        if self._data is None:
+            self._data = self.generate().encode('utf-8')
+            self.generate = None
+        return self._data
+
+    async def getattr(self) -> fusetree.Stat:
+        return fusetree.Stat(
+            st_mode = FILE_MODE,
+            st_size = len(self.data())
+        )
+
+    async def open(self, mode):
+        return SyntheticFile.Handle(self)
+
+    class Handle (fusetree.FileHandle):
+        async def read(self, size: int, offset: int) -> bytes:
+            return self.node.data()[offset:offset+size]
+
+
+class LazyNode(fusetree.Node):
+    """
+    Creates the actual node on first access
+    """
+    __slots__ = ('factory', '_node')
+
+    def __init__(self, factory: Callable[[], fusetree.Node]):
+        self.factory = factory
+        self._node = None
+
+    def node(self) -> fusetree.Node:
+        if self._node is None:
+            self._node = self.factory()
+            self.factory = None
+        return self._node
+
+    async def getattr(self) -> fusetree.Stat:
+        return await self.node().getattr()
+
+    async def open(self, mode):
+        return await self.node().open(mode)
+
+
+# Nodes are weakly referenced by NodeRegistry: Slotted classes need a __weakref__ slot, unless fusetree.Node already has one
+_WEAKREF_SLOT = () if hasattr(fusetree.Node, '__weakref__') else ('__weakref__',)
+
+
 class SpotifyNode(fusetree.Node):
+    __slots__ = ('mode', 'spotifyfs', 'id') + _WEAKREF_SLOT
+
     def __init__(self, spotifyfs, id, mode):
         self.mode = mode
         self.spotifyfs = spotifyfs
         self.id = id
-        self.cache_id = (self.__class__.__name__, id)
 
+    @property
+    def cache_id(self):
+        return (self.__class__.__name__, self.id)
+
+    @metrics.timed(metrics.fuse_latency, op='getattr')
     async def getattr(self) -> fusetree.Stat:
         return fusetree.Stat(
             st_mode=self.mode
         )
 
     async def invalidate(self):
-        del self.spotifyfs.cache[self.cache_id]
+        self.spotifyfs.cache.pop(self.cache_id, None)
+        self.spotifyfs.metadata_cache.delete(self.cache_id)
 
 
 class SpotifyDir(SpotifyNode):
+    __slots__ = ('_raw_content', '_files', '_fetched_at', '_refresh_after')
+
     content_file: str = None
     image_file: str = None
     default_image = None
@@ -150,11 +660,20 @@ class SpotifyDir(SpotifyNode):
 
         self._raw_content = None
         self._files = None
+        self._fetched_at = None
+        self._refresh_after = 0
 
     async def invalidate(self):
-        super().invalidate()
+        await super().invalidate()
+        self.drop_files()
+
+    def drop_files(self):
+        """
+        Forgets the materialized content. It will be rebuilt from the caches when needed.
+        """
         self._raw_content = None
         self._files = None
+        self._fetched_at = None
 
     async def fetch_content(self):
         """
@@ -193,46 +712,151 @@ class SpotifyDir(SpotifyNode):
         Caching will be used for speed, call invalidate() if you expect something to change.
         """
         if self._raw_content is None:
-            self._raw_content = self.spotifyfs.cache.get(self.cache_id, None)
-            if self._raw_content is None:
-                self._raw_content = await self.fetch_content()
-                self.spotifyfs.cache[self.cache_id] = self._raw_content
+            content, fetched_at = await self.spotifyfs.content_fetches.run(self.cache_id, self._load_content)
+            if self._raw_content is None:  # A background refresh might have been faster
+                self._raw_content = content
+                self._fetched_at = fetched_at
+        elif time.time() - self._fetched_at > self.spotifyfs.metadata_cache.ttl(self.cache_id):
+            self.refresh_in_background()
         return self._raw_content
 
+    async def _load_content(self):
+        """
+        Returns (content, when it was fetched from Spotify)
+        """
+        cached = self.spotifyfs.cache.get(self.cache_id, None)
+        metrics.content_cache.inc(result='miss' if cached is None else 'hit')
+        if cached is None:
+            entry = self.spotifyfs.metadata_cache.get_entry(self.cache_id)
+            ttl = self.spotifyfs.metadata_cache.ttl(self.cache_id)
+            if entry is None:
+                cached = await self.fetch_content(), time.time()
+                self.spotifyfs.metadata_cache.set(self.cache_id, cached[0])
+            elif entry[1] <= ttl:
+                cached = entry[0], time.time() - entry[1]
+            elif entry[1] <= ttl + self.spotifyfs.max_stale:
+                # Stale: Serve it now, refresh it later
+                cached = entry[0], time.time() - entry[1]
+                self.refresh_in_background()
+            else:
+                cached = await self.revalidate(entry[0]), time.time()
+            self.spotifyfs.cache[self.cache_id] = cached
+        return cached
+
+    def refresh_in_background(self):
+        if time.monotonic() < self._refresh_after:
+            return  # The last attempt failed, don't hammer the API
+
+        async def run():
+            try:
+                await self.refresh()
+            except:
+                self._refresh_after = time.monotonic() + self.spotifyfs.refresh_retry
+                print(f'Background refresh of {self.cache_id} failed')
+                traceback.print_exc()
+        asyncio.ensure_future(self.spotifyfs.content_fetches.run(('refresh',) + self.cache_id, run))
+
+    def content_version(self, content):
+        """
+        Returns something that changes whenever the content changes (A playlist's `snapshot_id`,
+        a list's total and first items), or None if this directory can't be revalidated cheaply
+        """
+        return None
+
+    async def probe_version(self):
+        """
+        Fetches the current `content_version()`, with a cheap request
+        """
+        return None
+
+    async def update_unversioned(self, content):
+        """
+        Refetches the parts of `content` that `content_version()` doesn't cover.
+        Returns `content` itself if they haven't changed.
+        """
+        return content
+
+    async def revalidate(self, content):
+        """
+        Returns `content` if it is still up to date, or the new content otherwise
+        """
+        version = self.content_version(content)
+        if version is not None and version == await self.probe_version():
+            updated = await self.update_unversioned(content)
+            if updated is content:
+                self.spotifyfs.metadata_cache.touch(self.cache_id)
+            else:
+                self.spotifyfs.metadata_cache.set(self.cache_id, updated)
+            return updated
+
+        content = await self.fetch_content()
+        self.spotifyfs.metadata_cache.set(self.cache_id, content)
+        return content
+
+    async def refresh(self):
+        """
+        Checks for changes, and merges them into the existing files.
+
+        Unlike invalidate(), child nodes that haven't changed are kept, with their caches.
+        """
+        old_content = self._raw_content
+        if old_content is None:
+            entry = self.spotifyfs.metadata_cache.get_entry(self.cache_id)
+            old_content = entry[0] if entry is not None else None
+
+        if old_content is None:
+            content = await self.fetch_content()
+            self.spotifyfs.metadata_cache.set(self.cache_id, content)
+        else:
+            content = await self.revalidate(old_content)
+        self._fetched_at = time.time()
+        self.spotifyfs.cache[self.cache_id] = content, self._fetched_at
+
+        if content is old_content:
+            return
+        self._raw_content = content
+        if self._files is not None:
+            merge_files(self._files, await self.build_files(content))
+
     async def files(self) -> Dict[str, fusetree.Node]:
         if self._files is None:
-            content = await self.content()
-            content_desc = await self.describe_content(content)
-
-            files = {}
-            files['.directory'] = inspect.cleandoc(f"""
-                [Desktop Entry]
-                Name={content_desc.get('name', '')}
-                Comment={content_desc.get('url', '')}
-                Icon=./{self.image_file}
-                Type=Directory
-                """)
-
-            if self.content_file is not None:
-                files[self.content_file] = json.dumps(content, indent=4)
-
-            if self.image_file is not None:
-                image_url = content_desc.get('image', self.default_image)
-                if image_url is not None:
-                    files[self.image_file] = fusetree.HttpFile(image_url)
-
-            content_files = await self.content_to_files(content)
-            files.update({
-                escape_filename(name): node
-                for name, node in content_files.items()
-            })
-
-            self._files = files
+            self._files = await self.build_files(await self.content())
+        self.spotifyfs.touch_dir(self)
         return self._files
 
+    async def build_files(self, content) -> Dict[str, fusetree.Node]:
+        content_desc = await self.describe_content(content)
+
+        # Synthetic files are only generated if someone reads them
+        files = {}
+        files['.directory'] = SyntheticFile(lambda: inspect.cleandoc(f"""
+            [Desktop Entry]
+            Name={content_desc.get('name', '')}
+            Comment={content_desc.get('url', '')}
+            Icon=./{self.image_file}
+            Type=Directory
+            """))
+
+        if self.content_file is not None:
+            files[self.content_file] = SyntheticFile(lambda: json.dumps(content, indent=4))
+
+        if self.image_file is not None:
+            image_url = content_desc.get('image', self.default_image)
+            if image_url is not None:
+                files[self.image_file] = LazyNode(lambda: fusetree.HttpFile(image_url))
+
+        content_files = await self.content_to_files(content)
+        files.update({
+            escape_filename(name): node
+            for name, node in content_files.items()
+        })
+        return files
+
+    @metrics.timed(metrics.fuse_latency, op='opendir')
     async def opendir(self):
         return list((await self.files()).items())
 
+    @metrics.timed(metrics.fuse_latency, op='lookup')
     async def lookup(self, name: str):
         files = await self.files()
         return files.get(name, None)
@@ -350,22 +974,50 @@ class SpotifyDir(SpotifyNode):
 
 
 class ArtistNode(SpotifyDir):
+    __slots__ = ()
     content_file = '.artist.json'
     image_file = '.artist.jpg'
 
     async def fetch_content(self):
-        content, related_artists, top_tracks, albuns = await asyncio.gather(
-            self.spotifyfs.request(f'artists/{self.id}'),
+        content, albuns = await asyncio.gather(
+            self.fetch_artist(),
+            self.spotifyfs.request_list(f'artists/{self.id}/albums', params={'market': self.spotifyfs.country, 'limit': 50}),
+        )
+        content['albuns'] = albuns
+        return content
+
+    async def fetch_artist(self):
+        """
+        Everything but the albums: The artist, its related artists and top tracks
+        """
+        content, related_artists, top_tracks = await asyncio.gather(
+            self.spotifyfs.artists.get(self.id),
             self.spotifyfs.request(f'artists/{self.id}/related-artists'),
             self.spotifyfs.request(f'artists/{self.id}/top-tracks', params={'country': self.spotifyfs.country}),
-            self.spotifyfs.request_list(f'artists/{self.id}/albums', params={'market': self.spotifyfs.country, 'limit': 50}),
         )
+        content = dict(content)
         content['related-artists'] = related_artists['artists']
         content['top-tracks'] = top_tracks['tracks']
-        content['albuns'] = albuns
         return content
 
+    async def update_unversioned(self, content):
+        # Only the albums are covered by the version, the rest is cheap to refetch (And mostly revalidated by ETag)
+        updated = await self.fetch_artist()
+        updated['albuns'] = content['albuns']
+        return content if updated == content else updated
+
+    def content_version(self, content):
+        albuns = content['albuns']
+        return [len(albuns), [album['id'] for album in albuns[:50]]]
+
+    async def probe_version(self):
+        page = await self.spotifyfs.request(f'artists/{self.id}/albums', params={'market': self.spotifyfs.country, 'limit': 50})
+        return [page['total'], [album['id'] for album in page['items']]]
+
     async def content_to_files(self, content):
+        for artist in content['related-artists']:
+            self.spotifyfs.artists.prime(artist)
+
         return {
             'Related Artists': {
                 artist["name"]: self.spotifyfs.getArtist(artist['id'])
@@ -382,17 +1034,35 @@ class ArtistNode(SpotifyDir):
         }
 
 class AlbumNode(SpotifyDir):
+    __slots__ = ()
     content_file = '.album.json'
     image_file = '.album.jpg'
 
     async def fetch_content(self):
         album, tracks = await asyncio.gather(
-            self.spotifyfs.request(f'albums/{self.id}'),
-            self.spotifyfs.request_list(f'albums/{self.id}/tracks'),
+            self.spotifyfs.albums.get(self.id),
+            self.spotifyfs.request_list(f'albums/{self.id}/tracks', params={'limit': 50}),
         )
+        album = dict(album)
         album['tracks'] = tracks
         return album
 
+    async def update_unversioned(self, content):
+        # Only the tracks are covered by the version, the album itself (E.g., its cover) is refetched (And mostly revalidated by ETag)
+        album = await self.spotifyfs.request(f'albums/{self.id}', params={'market': self.spotifyfs.country})
+        self.spotifyfs.albums.prime(album, self.id)
+        updated = dict(album)
+        updated['tracks'] = content['tracks']
+        return content if updated == content else updated
+
+    def content_version(self, content):
+        tracks = content['tracks']
+        return [len(tracks), [track['id'] for track in tracks[:50]]]
+
+    async def probe_version(self):
+        page = await self.spotifyfs.request(f'albums/{self.id}/tracks', params={'limit': 50})
+        return [page['total'], [track['id'] for track in page['items']]]
+
     async def content_to_files(self, content):
         tracks = content['tracks']
 
@@ -421,12 +1091,23 @@ class AlbumNode(SpotifyDir):
 
 
 class FollowedArtistsNode(SpotifyDir):
+    __slots__ = ()
     content_file = '.followed_artists.json'
 
     async def fetch_content(self):
-        return await self.spotifyfs.request_list(f'me/following', params={'type': 'artist', 'limit': 50}, key='artists')
+        return await self.spotifyfs.request_list('me/following', params={'type': 'artist', 'limit': 50}, key='artists')
+
+    def content_version(self, content):
+        return [len(content), [artist['id'] for artist in content[:50]]]
+
+    async def probe_version(self):
+        page = (await self.spotifyfs.request('me/following', params={'type': 'artist', 'limit': 50}))['artists']
+        return [page['total'], [artist['id'] for artist in page['items']]]
 
     async def content_to_files(self, content):
+        for artist in content:
+            self.spotifyfs.artists.prime(artist)
+
         return {
             artist["name"]: self.spotifyfs.getArtist(artist['id'])
             for artist in content
@@ -434,6 +1115,7 @@ class FollowedArtistsNode(SpotifyDir):
 
 
 class TrackNode(SpotifyNode):
+    __slots__ = ('bitrate', 'duration_ms', 'shared_handle', '_stored_sizes')
     content_file = '.track.json'
 
     def __init__(self, spotifyfs, id, mode, duration_ms, bitrate=256):
@@ -441,31 +1123,225 @@ class TrackNode(SpotifyNode):
             self.bitrate = bitrate
             self.duration_ms = duration_ms
             self.shared_handle = None
+            self._stored_sizes = None
+
+    def lame_args(self):
+        return dict(
+            bitrate = self.bitrate,
+            write_id3tag_automatic = False
+        )
+
+    async def album(self):
+        track = await self.spotifyfs.tracks.get(self.id)
+        return await self.spotifyfs.getAlbum(track['album']['id']).content()
+
+    async def prefetch_next(self):
+        """
+        Starts encoding the tracks that follow this one in the album
+        """
+        try:
+            tracks = (await self.album())['tracks']
+            for i, track in enumerate(tracks):
+                if track['id'] == self.id:
+                    for next_track in tracks[i+1:i+1+self.spotifyfs.prefetch_tracks]:
+                        next_node = self.spotifyfs.getTrack(next_track['id'], next_track['duration_ms'])
+                        self.spotifyfs.audio_fetch.prefetch(next_node.id, next_node.lame_args())
+                    break
+        except:
+            print(f'Prefetching the tracks after {self.id} failed')
+            traceback.print_exc()
 
+    async def id3(self):
+        """
+        Returns the (ID3v1, ID3v2) tags of this track
+        """
+        tags = self.spotifyfs.id3_cache.get(self.id, None)
+        if tags is None:
+            tags = await self.spotifyfs.tag_builds.run(('id3', self.id), self._build_id3)
+            self.spotifyfs.id3_cache[self.id] = tags
+        id3v1, id3v2, album = tags
+
+        if self.spotifyfs.id3_cover and album is not None:
+            try:
+                id3v2 = add_id3_frame(id3v2, await self._cover(album))
+            except:
+                traceback.print_exc()
+        return id3v1, id3v2
+
+    async def _cover(self, album):
+        """
+        Returns the APIC frame with the album cover
+        """
+        cover = self.spotifyfs.cover_cache.get(album['id'], None)
+        if cover is None:
+            async def fetch():
+                from mutagen.id3 import ID3, APIC
+                from io import BytesIO
+
+                img_url = album['images'][0]['url']
+                async with self.spotifyfs.aiohttp_session.request(url=img_url, method='GET') as response:
+                    response.raise_for_status()
+                    albumart = await response.read()
+
+                # Render a tag with only the cover, and keep its frame
+                metadata = ID3()
+                metadata.add(APIC(encoding=3, mime='image/jpeg', type=3, desc=u'Cover', data=albumart))
+                fp = BytesIO()
+                metadata.save(fp, v1=0, padding=lambda info: 0)
+                return fp.getvalue()[10:]
+            cover = await self.spotifyfs.tag_builds.run(('cover', album['id']), fetch)
+            self.spotifyfs.cover_cache[album['id']] = cover
+        return cover
+
+    async def _build_id3(self):
+        """
+        Generate the ID3 tags to be wrapped around the actual MP3 stream
+        Inspired by spotify-downloader:
+        https://github.com/ritiek/spotify-downloader/blob/master/core/metadata.py
+
+        Returns (ID3v1, ID3v2 without the cover, album to take the cover from)
+        """
+        from mutagen.id3 import ID3, TIT2, TPE1, TALB, TPE2, TRCK, TPOS, TLEN, TDRC, TCON, TENC, TCOP, TSRC, WOAR
+        from io import BytesIO
+
+        track = await self.spotifyfs.tracks.get(self.id)
+        album = await self.album()
+
+        num_discs = 0
+        num_tracks = 0
+        for t in album['tracks']:
+            num_discs = max(num_discs, t['disc_number'])
+            if t['disc_number'] == track['disc_number']:
+                num_tracks = max(num_tracks, t['track_number'])
+
+        metadata = ID3()
+        metadata.add(WOAR(url=track['external_urls']['spotify']))
+        metadata.add(TIT2(encoding=3, text=track['name']))
+        metadata.add(TPE1(encoding=3, text=[artist['name'] for artist in track['artists']]))
+        metadata.add(TALB(encoding=3, text=album['name']))
+        metadata.add(TPE2(encoding=3, text=[artist['name'] for artist in album['artists']]))
+        metadata.add(TRCK(encoding=3, text=f"{track['track_number']}/{num_tracks}"))
+        metadata.add(TPOS(encoding=3, text=f"{track['disc_number']}/{num_discs}"))
+        metadata.add(TLEN(encoding=3, text=str(track['duration_ms'])))
+        metadata.add(TDRC(encoding=3, text=album['release_date']))
+        if album['genres']:
+            metadata.add(TCON(encoding=3, text=album['genres']))
+
+        try:
+            metadata.add(TENC(encoding=3, text=album['label']))
+        except:
+            pass
+
+        try:
+            metadata.add(TCOP(encoding=3, text=album['copyrights'][0]['text']))
+        except:
+            pass
+
+        try:
+            metadata.add(TSRC(encoding=3, text=track['external_ids']['isrc']))
+        except:
+            pass
+
+        # Only the parts of the album that are needed for the cover, not its tracklist
+        cover_album = {'id': track['album']['id'], 'images': track['album']['images']} if track['album'].get('images') else None
+
+        # Save v2 and v1 tags into an empty buffer: The v1 tag is the last 128 bytes
+        fp = BytesIO()
+        metadata.save(fp, v1=2)
+        data = fp.getvalue()
+        if data[-128:-125] == b'TAG':
+            return data[-128:], data[:-128], cover_album
+        return b'', data, cover_album
+
+    def known_audio_size(self):
+        """
+        Returns the exact size of the MP3 stream, or None if it isn't known yet
+        """
+        handle = self.shared_handle
+        if handle is not None and handle.playback is not None:
+            if handle.playback.finished and handle.playback.error is None:
+                return len(handle.playback.buf)
+
+        return self.stored_sizes()[1]
+
+    def stored_sizes(self):
+        """
+        Returns the (ID3v2, audio, ID3v1) sizes from the size index, and the size of the MP3 stream
+        from the size index or the audio cache. Either might be None.
+
+        They are looked up once, and then kept up to date by `Handle.release()`.
+        """
+        if self._stored_sizes is None:
+            sizes = self.spotifyfs.size_index.get(self.id, self.bitrate)
+            if sizes is not None:
+                audio_size = sizes[1]
+            elif self.spotifyfs.audio_cache is not None:
+                audio_size = self.spotifyfs.audio_cache.size(self.id, self.lame_args())
+            else:
+                audio_size = None
+            self._stored_sizes = sizes, audio_size
+        return self._stored_sizes
+
+    def cached_id3(self):
+        """
+        Returns the (ID3v1, ID3v2) tags of this track if they have already been generated, or None
+        """
+        handle = self.shared_handle
+        if handle is not None and handle.id3v2 is not None:
+            return handle.id3v1, handle.id3v2
+
+        tags = self.spotifyfs.id3_cache.get(self.id, None)
+        if tags is None:
+            return None
+        id3v1, id3v2, album = tags
+        if self.spotifyfs.id3_cover and album is not None:
+            cover = self.spotifyfs.cover_cache.get(album['id'], None)
+            if cover is None:
+                return None  # Size unknown until the cover is fetched again
+            id3v2 = add_id3_frame(id3v2, cover)
+        return id3v1, id3v2
+
+    def known_size(self):
+        """
+        Returns the exact (ID3v2, audio, ID3v1) sizes of this file, or None if they aren't known yet
+        """
+        audio_size = self.known_audio_size()
+        tags = self.cached_id3()
+        if audio_size is not None and tags is not None:
+            return len(tags[1]), audio_size, len(tags[0])
+
+        return self.stored_sizes()[0]
+
+    @metrics.timed(metrics.fuse_latency, op='getattr')
     async def getattr(self) -> fusetree.Stat:
-        id3_v1_size = 128  # Fix size ID3v1
-        id3_v2_size = 4096  # Wild guess -- Depends mostly on cover image
-        audio_size = self.duration_ms * self.bitrate // 8
-
-        #if self.shared_handle is not None:
-            #if self.shared_handle.id3v1 is not None:
-                #id3_v1_size = len(self.shared_handle.id3v1)
-            #if self.shared_handle.id3v2 is not None:
-                #id3_v2_size = len(self.shared_handle.id3v2)
-            #if self.shared_handle.playback is not None:
-                #if self.shared_handle.playback.finished and self.shared_handle.playback.error is None:
-                    #audio_size = len(self.shared_handle.playback.buf)
-                #else:
-                    #audio_size = max(audio_size, len(self.shared_handle.playback.buf))
+        sizes = self.known_size()
+        if sizes is None:
+            id3_v1_size = 128  # Fix size ID3v1
+            id3_v2_size = 4096  # Wild guess -- Depends mostly on cover image
+            audio_size = self.known_audio_size()
+            if audio_size is None:
+                audio_size = cbr_stream_size(self.duration_ms, self.bitrate)
+
+            tags = self.cached_id3()
+            if tags is not None:
+                id3_v1_size = len(tags[0])
+                id3_v2_size = len(tags[1])
+
+            handle = self.shared_handle
+            if handle is not None and handle.playback is not None:
+                audio_size = max(audio_size, len(handle.playback.buf))
+            sizes = id3_v2_size, audio_size, id3_v1_size
 
         return fusetree.Stat(
             st_mode = self.mode,
-            st_size = id3_v1_size + id3_v2_size + audio_size
+            st_size = sum(sizes)
         )
 
+    @metrics.timed(metrics.fuse_latency, op='open')
     async def open(self, mode):
         if self.shared_handle is None:
             self.shared_handle = TrackNode.Handle(self)
+        self.spotifyfs.unlinger(self.shared_handle)
         self.shared_handle.refs += 1
         return self.shared_handle
 
@@ -475,28 +1351,38 @@ class TrackNode(SpotifyNode):
             self.playback = None
             self.id3v1 = None
             self.id3v2 = None
+            self.prefetched = False
             self.refs = 0
 
+        @metrics.timed(metrics.fuse_latency, op='read')
         async def read(self, size: int, offset: int) -> bytes:
             if self.id3v2 is None:
-                track = await self.node.spotifyfs.request(f'tracks/{self.node.id}')
-                album = await self.node.spotifyfs.getAlbum(track['album']['id']).content()
-                self.id3v1, self.id3v2 = await self.id3(track, album)
-                print('ID3v2 len=', len(self.id3v2))
+                self.id3v1, self.id3v2 = await self.node.id3()
             ret = self.id3v2[offset:offset+size]
             if len(ret) != 0:
                 return ret
             else:
                 offset -= len(self.id3v2)
 
+            # Reads of the trailing ID3v1 tag don't need to play the track if we know where it starts
+            if self.playback is None or not self.playback.finished:
+                audio_size = self.node.known_audio_size()
+                if audio_size is not None and offset >= audio_size:
+                    offset -= audio_size
+                    return self.id3v1[offset:offset+size]
 
             if self.playback is None:
                 self.playback = self.node.spotifyfs.audio_fetch.play(
                         self.node.id,
-                        lame_args = dict(
-                            bitrate = self.node.bitrate,
-                            write_id3tag_automatic = False
-                        ))
+                        lame_args = self.node.lame_args(),
+                        size = self.node.known_audio_size() or cbr_stream_size(self.node.duration_ms, self.node.bitrate))
+
+            spotifyfs = self.node.spotifyfs
+            if not self.prefetched and spotifyfs.prefetch_tracks > 0:
+                if offset >= spotifyfs.prefetch_at * cbr_stream_size(self.node.duration_ms, self.node.bitrate):
+                    self.prefetched = True
+                    asyncio.ensure_future(self.node.prefetch_next())
+
             ret = await self.playback.read(offset, size)
             if len(ret) != 0:
                 return ret
@@ -506,89 +1392,80 @@ class TrackNode(SpotifyNode):
 
             return self.id3v1[offset:offset+size]
 
+        @metrics.timed(metrics.fuse_latency, op='release')
         async def release(self) -> None:
             self.refs -= 1
             if self.refs == 0:
+                sizes = self.node.known_size()
+                if sizes is not None:
+                    self.node.spotifyfs.size_index.set(self.node.id, self.node.bitrate, *sizes)
+                    self.node._stored_sizes = sizes, sizes[1]
+                else:
+                    self.node._stored_sizes = None, self.node.known_audio_size()
+
+                if self.node.spotifyfs.linger_time > 0:
+                    self.node.spotifyfs.linger(self)
+                else:
+                    await self.close()
+
+        async def close(self) -> None:
+            if self.refs > 0:
+                return  # Reopened
+
+            if self.node.shared_handle is self:
                 self.node.shared_handle = None
 
-                if self.playback is not None:
-                    await self.playback.close()
-
-        async def id3(self, track, album):
-            """
-            Generate an ID3 frame to be prepended to actual MP3 stream
-            Inspired by spotify-downloader:
-            https://github.com/ritiek/spotify-downloader/blob/master/core/metadata.py
-            """
-            from mutagen.easyid3 import EasyID3
-            from mutagen.id3 import ID3, TORY, TYER, TPUB, APIC, USLT, COMM
-            import tempfile
-
-            with tempfile.TemporaryFile() as fp:
-                num_discs = 0
-                num_tracks = 0
-                for t in album['tracks']:
-                    num_discs = max(num_discs, t['disc_number'])
-                    if t['disc_number'] == track['disc_number']:
-                        num_tracks = max(num_tracks, t['track_number'])
-
-                metadata = EasyID3()
-                metadata['website'] = track['external_urls']['spotify']
-                metadata['title'] = track['name']
-                metadata['artist'] = [artist['name'] for artist in track['artists']]
-                metadata['album'] = album['name']
-                metadata['albumartist'] = [artist['name'] for artist in album['artists']]
-                metadata['tracknumber'] = [track['track_number'], num_tracks]
-                metadata['discnumber'] = [track['disc_number'], num_discs]
-                metadata['length'] = str(track['duration_ms'] / 1000.0)
-                metadata['date'] = album['release_date']
-                metadata['genre'] = album['genres']
-
-                try:
-                    metadata['encodedby'] = album['label']
-                except:
-                    pass
-
-                try:
-                    metadata['copyright'] = album['copyrights'][0]['text']
-                except:
-                    pass
-
-                try:
-                    metadata['isrc'] = track['external_ids']['isrc']
-                except:
-                    pass
-
-                metadata.save(fp, v1=2)
-                fp.seek(0)
+            if self.playback is not None:
+                playback, self.playback = self.playback, None
+                await playback.close()
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Mounts your Spotify library as a filesystem')
+    parser.add_argument('mountpoint')
+    parser.add_argument('--country', default='us')
+    parser.add_argument('--audio-cache-dir', default=None)
+    parser.add_argument('--audio-cache-size', type=int, default=2*1024, metavar='MB',
+                        help='Size of the on-disk cache of encoded tracks, 0 disables it')
+    parser.add_argument('--playback-workers', type=int, default=2,
+                        help='Number of tracks that can be streamed at the same time')
+    parser.add_argument('--seekable', action='store_true',
+                        help='Serve reads far ahead of the encoded audio by starting another playback from there. '
+                             'That playback is a separate MP3 stream, so the bytes served ahead can differ slightly '
+                             'from the ones read later at the same offset')
+    parser.add_argument('--prefetch-tracks', type=int, default=0,
+                        help='Number of following album tracks to encode in background')
+    parser.add_argument('--linger', type=float, default=10, metavar='SECONDS',
+                        help='Keep streams alive this long after a file is closed')
+    parser.add_argument('--warmup', type=int, default=0, metavar='DEPTH',
+                        help='Crawl the tree up to DEPTH levels after mounting, to fill the metadata cache')
+    parser.add_argument('--warmup-concurrency', type=int, default=4)
+    parser.add_argument('--warmup-tracks', action='store_true',
+                        help='Also build ID3 tags (and fetch cover art) during warm-up')
+    parser.add_argument('--max-stale', type=float, default=7*24, metavar='HOURS',
+                        help='Keep serving expired listings this long while they are refreshed in background')
+    parser.add_argument('--metrics-port', type=int, default=None, metavar='PORT',
+                        help='Serve Prometheus metrics on http://127.0.0.1:PORT/metrics (They are always readable on .stats)')
+    args = parser.parse_args()
 
-                metadata = ID3(fp)
-                try:
-                    img_url = track['album']['images'][0]['url']
-                    async with self.node.spotifyfs.aiohttp_session.request(url=img_url, method='GET') as response:
-                        albumart = await response.read()
-                        metadata['APIC'] = APIC(encoding=3, mime='image/jpeg', type=3, desc=u'Cover', data=albumart)
-                except:
-                    import traceback
-                    traceback.print_exc()
-                    pass
-
-                ##try to fetch lyrics -- This can be improved...
-                #try:
-                    #import lyricwikia
-                    #print('Looking for lyrics', track['artists'][0]['name'], track['name'])
-                    #lyrics = lyricwikia.get_lyrics(track['artists'][0]['name'], track['name'])
-                    #metadata['USLT'] = USLT(encoding=3, desc=u'Lyrics', text=lyrics)
-                #except:
-                    #print('lyrics lookup failed')
-                    #pass
-
-                metadata.save(fp)
-                fp.seek(0)
-
-                return b'', fp.read()
+    logging.basicConfig(level=logging.DEBUG)
+    spotifyfs = SpotifyFS(
+        country=args.country,
+        audio_cache_dir=args.audio_cache_dir,
+        audio_cache_size=args.audio_cache_size*1024*1024,
+        playback_workers=args.playback_workers,
+        seekable_streams=args.seekable,
+        prefetch_tracks=args.prefetch_tracks,
+        linger_time=args.linger,
+        warmup_depth=args.warmup,
+        warmup_concurrency=args.warmup_concurrency,
+        warmup_tracks=args.warmup_tracks,
+        max_stale=args.max_stale*3600,
+        metrics_port=args.metrics_port)
+    fusetree.FuseTree(spotifyfs, args.mountpoint, foreground=True)
 
 
 if __name__ == '__main__':
-    logging.basicConfig(level=logging.DEBUG)
-    fusetree.FuseTree(SpotifyFS(), sys.argv[1], foreground=True)
+    main()
@@ -0,0 +1,208 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+from bisect import bisect_right
+import mmap
+import tempfile
+import weakref
+
+
+class MemoryBudget:
+    """
+    Limits how much encoded audio all StreamBuffers keep in RAM.
+
+    Once the limit is exceeded, the buffers holding most memory are spilled to their temporary files.
+
+    If an `executor` is given, the files are written on it and the buffers are updated on `loop`
+    once done, so that spilling doesn't block the event loop. Otherwise, they are spilled right away.
+    """
+
+    def __init__(self, limit=256*1024*1024, loop=None, executor=None):
+        self.limit = limit
+        self.loop = loop
+        self.executor = executor
+        self.used = 0
+        self.spilling = 0  # Bytes being written by background spills, not yet released
+        self.buffers = weakref.WeakSet()
+
+    def charge(self, size):
+        self.used += size
+        if self.used - self.spilling > self.limit:
+            for buf in sorted(self.buffers, key=lambda buf: buf.in_memory - buf.spilling, reverse=True):
+                if self.used - self.spilling <= self.limit:
+                    break
+                if self.executor is None:
+                    buf.spill()
+                else:
+                    buf.spill_in_background(self.loop, self.executor)
+
+    def release(self, size):
+        self.used -= size
+
+
+class StreamBuffer:
+    """
+    Append-only byte buffer made of the chunks produced by the encoder.
+
+    Appending never copies what is already in the buffer, and reads only copy the requested range.
+
+    If a MemoryBudget is given, the buffer may be asked to spill its chunks to a temporary file,
+    which is memory-mapped for reads. The spilled data is always a prefix of the stream.
+    """
+
+    def __init__(self, budget=None):
+        self._chunks = []
+        self._offsets = []  # Offset of the first byte of each chunk
+        self._size = 0
+
+        self._budget = budget
+        self._file = None
+        self._mmap = None
+        self._spilled = 0
+        self.in_memory = 0
+        self.spilling = 0  # Bytes being written by a background spill
+        self.closed = False
+        if budget is not None:
+            budget.buffers.add(self)
+
+    def __len__(self):
+        return self._size
+
+    def append(self, data):
+        if not data or self.closed:
+            return
+        self._offsets.append(self._size)
+        self._chunks.append(data)
+        self._size += len(data)
+        self.in_memory += len(data)
+        if self._budget is not None:
+            self._budget.charge(len(data))
+
+    def spill(self):
+        """
+        Moves all in-memory chunks to the temporary file
+        """
+        if not self._chunks or self.closed or self.spilling:
+            return
+        chunks = list(self._chunks)
+        self._spilled_to(len(chunks), self._size, self._write(chunks, self._size))
+
+    def spill_in_background(self, loop, executor):
+        """
+        Like `spill()`, but the file is written on `executor`.
+
+        Chunks appended meanwhile stay in memory, and reads are served from the chunks until the
+        spilled data is mapped back on `loop`.
+        """
+        if not self._chunks or self.closed or self.spilling:
+            return
+        chunks = list(self._chunks)
+        size = self._size
+        self.spilling = size - self._spilled
+        self._budget.spilling += self.spilling
+
+        def done(future):
+            self._budget.spilling -= self.spilling
+            self.spilling = 0
+            if future.cancelled() or future.exception() is not None:
+                print('Failed to spill stream buffer:', future.exception() if not future.cancelled() else 'cancelled')
+                if self.closed:
+                    self._close_file()
+                return
+            self._spilled_to(len(chunks), size, future.result())
+
+        loop.run_in_executor(executor, self._write, chunks, size).add_done_callback(done)
+
+    def _write(self, chunks, size):
+        """
+        Appends `chunks` to the temporary file and maps its first `size` bytes.
+        May run on another thread: It only touches the file.
+        """
+        if self._file is None:
+            self._file = tempfile.TemporaryFile(prefix='spotifyfs-')
+        self._file.seek(0, 2)
+        for chunk in chunks:
+            self._file.write(chunk)
+        self._file.flush()
+        return mmap.mmap(self._file.fileno(), size, access=mmap.ACCESS_READ)
+
+    def _spilled_to(self, count, size, new_mmap):
+        """
+        Replaces the first `count` chunks, up to `size`, by the spilled file
+        """
+        if self.closed:
+            new_mmap.close()
+            self._close_file()
+            return
+
+        if self._mmap is not None:
+            self._mmap.close()
+        self._mmap = new_mmap
+        released = size - self._spilled
+        self._spilled = size
+
+        del self._chunks[:count]
+        del self._offsets[:count]
+        self.in_memory -= released
+        if self._budget is not None:
+            self._budget.release(released)
+
+    def _release_memory(self):
+        if self._budget is not None:
+            self._budget.release(self.in_memory)
+        self.in_memory = 0
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self._release_memory()
+        self._chunks = []
+        self._offsets = []
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+        # A background spill is still writing the file, it gets closed when it is done
+        if not self.spilling:
+            self._close_file()
+
+    def _close_file(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def read(self, offset, length):
+        end = min(offset + length, self._size)
+        if offset >= end:
+            return b''
+
+        pieces = []
+        if offset < self._spilled:
+            spilled_end = min(end, self._spilled)
+            pieces.append(self._mmap[offset:spilled_end])
+            offset = spilled_end
+
+        i = bisect_right(self._offsets, offset) - 1
+        while offset < end:
+            chunk = self._chunks[i]
+            chunk_start = self._offsets[i]
+            chunk_end = min(chunk_start + len(chunk), end)
+            pieces.append(memoryview(chunk)[offset - chunk_start:chunk_end - chunk_start])
+            offset = chunk_end
+            i += 1
+
+        if len(pieces) == 1:
+            return bytes(pieces[0])
+        return b''.join(pieces)
+
+    def __del__(self):
+        self.close()
+
+    def __getitem__(self, key):
+        if not isinstance(key, slice) or key.step not in (None, 1):
+            raise TypeError('StreamBuffer only supports contiguous slices')
+        start, stop, _ = key.indices(self._size)
+        return self.read(start, stop - start)
+
+    def getvalue(self):
+        return self.read(0, self._size)
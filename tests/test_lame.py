@@ -0,0 +1,67 @@
+import pytest
+
+try:
+    import numpy as np
+    from lame import Lame, cbr_stream_size, cbr_frame_start, cbr_frame_offset, cbr_padding_period
+except (ImportError, OSError) as e:  # numpy, libmp3lame
+    pytest.skip(f'lame cannot be imported: {e}', allow_module_level=True)
+
+
+@pytest.mark.parametrize('bitrate', [128, 320])
+@pytest.mark.parametrize('duration_ms', [1000, 12345, 180000])
+def test_cbr_stream_size(bitrate, duration_ms):
+    lame = Lame(bitrate=bitrate, write_id3tag_automatic=False)
+    lame.init_params()
+
+    num_samples = duration_ms * 44100 // 1000
+    pcm = np.zeros(2 * num_samples, np.int16)  # Interleaved stereo silence
+    encoded = lame.encode_buffer(pcm) + lame.encode_flush_nogap()
+
+    assert len(encoded) == cbr_stream_size(duration_ms, bitrate)
+
+
+def frame_offsets(stream):
+    """
+    Offsets of the frames of an MPEG-1 Layer III stream, from their headers
+    """
+    bitrates = [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320]
+    offsets = []
+    offset = 0
+    while offset + 4 <= len(stream):
+        assert stream[offset] == 0xff and stream[offset + 1] & 0xe0 == 0xe0
+        offsets.append(offset)
+        bitrate = bitrates[stream[offset + 2] >> 4]
+        padding = (stream[offset + 2] >> 1) & 1
+        offset += 144000 * bitrate // 44100 + padding
+    assert offset == len(stream)
+    return offsets
+
+
+@pytest.mark.parametrize('bitrate', [128, 256, 320])
+def test_cbr_frame_offset(bitrate):
+    lame = Lame(bitrate=bitrate, write_id3tag_automatic=False)
+    lame.init_params()
+    pcm = np.zeros(2 * 44100 * 5, np.int16)
+    encoded = lame.encode_buffer(pcm) + lame.encode_flush_nogap()
+
+    offsets = frame_offsets(encoded)
+    assert offsets == [cbr_frame_offset(i, bitrate) for i in range(len(offsets))]
+
+
+@pytest.mark.parametrize('bitrate', [128, 256, 320])
+def test_cbr_frame_start(bitrate):
+    assert cbr_frame_start(0, bitrate) == (0, 0)
+    for frame in range(1, 2000, 7):
+        start = cbr_frame_offset(frame, bitrate)
+        end = cbr_frame_offset(frame + 1, bitrate)
+        assert cbr_frame_start(start, bitrate) == (frame, start)
+        assert cbr_frame_start(end - 1, bitrate) == (frame, start)
+    # From the review: Frame 2 of a 256kbps stream starts at 1670
+    assert cbr_frame_start(1671, 256) == (2, 1670)
+
+
+@pytest.mark.parametrize('bitrate', [128, 256, 320])
+def test_cbr_padding_period(bitrate):
+    period = cbr_padding_period(bitrate)
+    frame_sizes = [cbr_frame_offset(i + 1, bitrate) - cbr_frame_offset(i, bitrate) for i in range(2, 2 + 3 * period)]
+    assert frame_sizes[:period] == frame_sizes[period:2 * period] == frame_sizes[2 * period:]
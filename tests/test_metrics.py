@@ -0,0 +1,33 @@
+import metrics
+
+
+def test_render_mixed_label_types():
+    registry = metrics.Registry()
+    requests = registry.counter('requests_total', 'Requests', ['endpoint', 'status'])
+    requests.inc(endpoint='/artists/:id', status=200)
+    requests.inc(endpoint='/artists/:id', status='error')
+    requests.inc(endpoint='/artists/:id', status=200)
+
+    text = registry.render()
+    assert 'requests_total{endpoint="/artists/:id",status="200"} 2' in text
+    assert 'requests_total{endpoint="/artists/:id",status="error"} 1' in text
+    assert requests.get(endpoint='/artists/:id', status=200) == 2
+
+
+def test_render_histogram():
+    registry = metrics.Registry()
+    latency = registry.histogram('latency_seconds', 'Latency', ['op'], buckets=(0.1, 1))
+    latency.observe(0.05, op='read')
+    latency.observe(0.5, op='read')
+    latency.observe(5, op='read')
+
+    lines = registry.render().splitlines()
+    assert 'latency_seconds_bucket{op="read",le="0.1"} 1' in lines
+    assert 'latency_seconds_bucket{op="read",le="1"} 2' in lines
+    assert 'latency_seconds_bucket{op="read",le="+Inf"} 3' in lines
+    assert 'latency_seconds_count{op="read"} 3' in lines
+
+
+def test_api_endpoint():
+    assert metrics.api_endpoint('/artists/abc/albums?limit=50') == '/artists/:id/albums'
+    assert metrics.api_endpoint('/me/following') == '/me/following'
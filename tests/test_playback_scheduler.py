@@ -0,0 +1,101 @@
+import asyncio
+
+from playback_scheduler import PlaybackScheduler, PRIORITY_INTERACTIVE, PRIORITY_PREFETCH
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+def test_free_workers_are_handed_out_immediately():
+    async def main():
+        scheduler = PlaybackScheduler(['w0', 'w1'])
+        a = scheduler.enqueue(PRIORITY_PREFETCH)
+        b = scheduler.enqueue(PRIORITY_INTERACTIVE)
+        assert {await scheduler.wait(a), await scheduler.wait(b)} == {'w0', 'w1'}
+        assert scheduler.free == [] and scheduler.waiting == []
+    run(main())
+
+
+def test_interactive_before_prefetch_then_fifo():
+    async def main():
+        scheduler = PlaybackScheduler(['w0'])
+        busy = scheduler.enqueue(PRIORITY_INTERACTIVE)
+        worker = await scheduler.wait(busy)
+
+        prefetch1 = scheduler.enqueue(PRIORITY_PREFETCH)
+        prefetch2 = scheduler.enqueue(PRIORITY_PREFETCH)
+        interactive = scheduler.enqueue(PRIORITY_INTERACTIVE)
+
+        order = []
+        for ticket in (interactive, prefetch1, prefetch2):
+            scheduler.release(worker)
+            assert ticket.future.done()
+            worker = await scheduler.wait(ticket)
+            order.append(ticket)
+        assert order == [interactive, prefetch1, prefetch2]
+    run(main())
+
+
+def test_boost():
+    async def main():
+        scheduler = PlaybackScheduler(['w0'])
+        worker = await scheduler.wait(scheduler.enqueue(PRIORITY_INTERACTIVE))
+
+        interactive = scheduler.enqueue(PRIORITY_INTERACTIVE)
+        prefetch = scheduler.enqueue(PRIORITY_PREFETCH)
+        scheduler.boost(interactive, PRIORITY_PREFETCH)  # Never lowers the priority
+        scheduler.boost(prefetch, PRIORITY_INTERACTIVE)
+
+        scheduler.release(worker)
+        assert interactive.future.done()  # Same priority now, enqueued first
+        assert not prefetch.future.done()
+    run(main())
+
+
+def test_aging():
+    async def main():
+        scheduler = PlaybackScheduler(['w0'], aging=10)
+        worker = await scheduler.wait(scheduler.enqueue(PRIORITY_INTERACTIVE))
+
+        prefetch = scheduler.enqueue(PRIORITY_PREFETCH)
+        interactive = scheduler.enqueue(PRIORITY_INTERACTIVE)
+        prefetch.enqueued -= 15  # Waited more than one priority level
+
+        scheduler.release(worker)
+        assert prefetch.future.done()
+        assert not interactive.future.done()
+    run(main())
+
+
+def test_cancel_while_waiting():
+    async def main():
+        scheduler = PlaybackScheduler(['w0'])
+        worker = await scheduler.wait(scheduler.enqueue(PRIORITY_INTERACTIVE))
+
+        ticket = scheduler.enqueue(PRIORITY_INTERACTIVE)
+        task = asyncio.ensure_future(scheduler.wait(ticket))
+        await asyncio.sleep(0)
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        assert scheduler.waiting == []
+
+        scheduler.release(worker)
+        assert scheduler.free == ['w0']
+    run(main())
+
+
+def test_cancel_after_dispatch_releases_worker():
+    async def main():
+        scheduler = PlaybackScheduler(['w0'])
+        worker = await scheduler.wait(scheduler.enqueue(PRIORITY_INTERACTIVE))
+
+        ticket = scheduler.enqueue(PRIORITY_INTERACTIVE)
+        task = asyncio.ensure_future(scheduler.wait(ticket))
+        await asyncio.sleep(0)
+        scheduler.release(worker)  # Dispatched to `ticket`, but its waiter gets cancelled before resuming
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        assert task.cancelled()
+        assert scheduler.free == ['w0']
+    run(main())
@@ -0,0 +1,113 @@
+import pytest
+
+try:
+    from spotifyfs import merge_files
+except (ImportError, OSError) as e:  # fusetree, spotipy, librespot, libmp3lame...
+    pytest.skip(f'spotifyfs cannot be imported: {e}', allow_module_level=True)
+
+
+def test_merge_files_keeps_unchanged_nodes():
+    kept = object()
+    removed = object()
+    nested_kept = object()
+    files = {
+        'kept': kept,
+        'removed': removed,
+        'Albums': {'a': nested_kept, 'b': object()},
+    }
+    albums = files['Albums']
+
+    added = object()
+    replaced = object()
+    merge_files(files, {
+        'kept': kept,
+        'added': added,
+        'Albums': {'a': nested_kept, 'b': replaced},
+    })
+
+    assert files == {'kept': kept, 'added': added, 'Albums': {'a': nested_kept, 'b': replaced}}
+    assert files['Albums'] is albums  # Nested folders are updated in place
+
+
+def test_merge_files_folder_replaced_by_node():
+    node = object()
+    files = {'x': {'a': object()}}
+    merge_files(files, {'x': node})
+    assert files == {'x': node}
+
+
+class FakePages:
+    """
+    Answers `request()` with the pages of an offset-paginated list of `total` items
+    """
+    def __init__(self, total, limit):
+        self.total = total
+        self.limit = limit
+        self.offsets = []
+
+    async def request(self, url, **kwargs):
+        import urllib.parse
+        query = dict(urllib.parse.parse_qsl(urllib.parse.urlparse(url).query))
+        offset = int(query.get('offset', 0))
+        self.offsets.append(offset)
+        next_offset = offset + self.limit
+        return {
+            'items': list(range(offset, min(next_offset, self.total))),
+            'offset': offset,
+            'limit': self.limit,
+            'total': self.total,
+            'next': f'https://api.spotify.com/v1/list?offset={next_offset}&limit={self.limit}' if next_offset < self.total else None,
+        }
+
+
+@pytest.mark.parametrize('total', [0, 1, 49, 50, 51, 120, 150])
+def test_request_list_offset_pages(total):
+    import asyncio
+    from spotifyfs import SpotifyFS
+
+    pages = FakePages(total, limit=50)
+    fs = SpotifyFS.__new__(SpotifyFS)  # Without logging in
+    fs.request = pages.request
+
+    items = asyncio.run(fs.request_list('list?limit=50', max_concurrency=2))
+    assert items == list(range(total))
+    assert sorted(pages.offsets) == list(range(0, max(total, 1), 50))
+
+
+def test_request_list_keeps_shared_first_page():
+    import asyncio
+    from spotifyfs import SpotifyFS
+
+    pages = FakePages(120, limit=50)
+    first_pages = []
+
+    async def request(url, **kwargs):
+        page = await pages.request(url, **kwargs)
+        if not first_pages:
+            first_pages.append(page)  # Coalesced requests get this same object
+        return page
+
+    fs = SpotifyFS.__new__(SpotifyFS)  # Without logging in
+    fs.request = request
+
+    assert asyncio.run(fs.request_list('list?limit=50')) == list(range(120))
+    assert first_pages[0]['items'] == list(range(50))
+
+
+def test_track_sizes_are_looked_up_once():
+    import types
+    from spotifyfs import TrackNode
+
+    lookups = []
+
+    class FakeSizeIndex:
+        def get(self, track_id, bitrate):
+            lookups.append((track_id, bitrate))
+            return None
+
+    fs = types.SimpleNamespace(size_index=FakeSizeIndex(), audio_cache=None, id3_cache={})
+    node = TrackNode(fs, 'track', 0o444, duration_ms=180000)
+    for _ in range(3):
+        assert node.known_size() is None
+        assert node.known_audio_size() is None
+    assert lookups == [('track', 256)]
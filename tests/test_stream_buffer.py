@@ -0,0 +1,137 @@
+import asyncio
+import concurrent.futures
+import random
+
+import pytest
+
+from stream_buffer import StreamBuffer, MemoryBudget
+
+
+def fill(buf, seed=0, chunks=50):
+    rng = random.Random(seed)
+    expected = b''
+    for i in range(chunks):
+        chunk = bytes(rng.getrandbits(8) for _ in range(rng.randint(1, 300)))
+        buf.append(chunk)
+        expected += chunk
+    return expected
+
+
+def check_reads(buf, expected, seed=0):
+    rng = random.Random(seed)
+    assert len(buf) == len(expected)
+    assert buf.getvalue() == expected
+    for _ in range(200):
+        offset = rng.randint(0, len(expected) + 10)
+        length = rng.randint(0, 1000)
+        assert buf.read(offset, length) == expected[offset:offset+length]
+        assert buf[offset:offset+length] == expected[offset:offset+length]
+
+
+def test_append_and_read():
+    buf = StreamBuffer()
+    expected = fill(buf)
+    check_reads(buf, expected)
+
+
+def test_empty_chunks_are_ignored():
+    buf = StreamBuffer()
+    buf.append(b'')
+    buf.append(b'abc')
+    buf.append(b'')
+    assert len(buf) == 3
+    assert buf.read(0, 10) == b'abc'
+    assert buf.read(3, 10) == b''
+
+
+def test_only_contiguous_slices():
+    buf = StreamBuffer()
+    buf.append(b'abcdef')
+    with pytest.raises(TypeError):
+        buf[1]
+    with pytest.raises(TypeError):
+        buf[::2]
+
+
+def test_spill_and_keep_appending():
+    buf = StreamBuffer()
+    expected = fill(buf, seed=1)
+    buf.spill()
+    assert buf.in_memory == 0
+    check_reads(buf, expected, seed=1)
+
+    # Reads spanning the spilled file and the chunks appended afterwards
+    expected += fill(buf, seed=2)
+    check_reads(buf, expected, seed=2)
+
+    buf.spill()
+    expected += fill(buf, seed=3)
+    check_reads(buf, expected, seed=3)
+    buf.close()
+
+
+def test_budget_spills_largest_buffers():
+    budget = MemoryBudget(limit=1000)
+    small = StreamBuffer(budget)
+    large = StreamBuffer(budget)
+    small.append(b's' * 100)
+    large.append(b'l' * 800)
+    assert budget.used == 900
+    assert small.in_memory == 100 and large.in_memory == 800
+
+    large.append(b'L' * 200)
+    assert budget.used <= budget.limit
+    assert large.in_memory == 0
+    assert small.in_memory == 100
+    assert large.getvalue() == b'l' * 800 + b'L' * 200
+    assert small.getvalue() == b's' * 100
+
+
+def test_close_releases_budget():
+    budget = MemoryBudget(limit=1000)
+    buf = StreamBuffer(budget)
+    buf.append(b'x' * 500)
+    buf.close()
+    assert budget.used == 0
+    buf.append(b'y')
+    assert len(buf) == 500
+    assert budget.used == 0
+
+
+def test_background_spill():
+    loop = asyncio.new_event_loop()
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    budget = MemoryBudget(limit=1000, loop=loop, executor=executor)
+    buf = StreamBuffer(budget)
+    buf.append(b'a' * 800)
+    buf.append(b'b' * 300)
+
+    # The file is written in the background, meanwhile reads come from memory
+    assert buf.spilling == 1100 and budget.spilling == 1100
+    buf.append(b'c' * 100)
+    assert buf.getvalue() == b'a' * 800 + b'b' * 300 + b'c' * 100
+
+    loop.run_until_complete(asyncio.sleep(0.1))
+    assert buf.spilling == 0 and budget.spilling == 0
+    assert buf.in_memory == 100 and budget.used == 100
+    assert buf.getvalue() == b'a' * 800 + b'b' * 300 + b'c' * 100
+
+    buf.close()
+    loop.close()
+    executor.shutdown()
+
+
+def test_close_during_background_spill():
+    loop = asyncio.new_event_loop()
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    budget = MemoryBudget(limit=1000, loop=loop, executor=executor)
+    buf = StreamBuffer(budget)
+    buf.append(b'x' * 1100)
+    buf.close()
+    assert budget.used == 0
+
+    loop.run_until_complete(asyncio.sleep(0.1))
+    assert budget.used == 0 and budget.spilling == 0
+    assert buf._file is None and buf._mmap is None
+    loop.close()
+    executor.shutdown()